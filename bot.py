@@ -1,4 +1,4 @@
-import os, json, logging, re
+import os, json, logging, re, asyncio, time, sqlite3, functools, secrets
 from datetime import datetime
 from io import BytesIO
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
@@ -6,11 +6,19 @@ from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQu
 import google.generativeai as genai
 import gspread
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
 from PIL import Image
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from http.server import HTTPServer, BaseHTTPRequestHandler
 import threading
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Load environment variables
 load_dotenv()
 
@@ -23,101 +31,264 @@ genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
 model = genai.GenerativeModel('gemini-1.5-flash')
 
 # File paths and global variables
-USERS_FILE = 'users.json'
-CATEGORIES_FILE = 'categories.json'
+DB_FILE = 'users.db'
+USERS_FILE = 'users.json'  # legacy, migrated into DB_FILE on first load
+CATEGORIES_FILE = 'categories.json'  # legacy, migrated into DB_FILE on first load
+MONTH_INDEX_FILE = 'month_index.json'
+db = None
+# One connection shared with the Sheets worker threads (get_user_sheet saves users); hold this around every use
+db_lock = threading.Lock()
 user_sheets = {}
 user_categories = {}
-pending_expenses = {}
-user_states = {}
+user_category_matchers = {}
+month_index = {}  # user_id -> [month, first sheet row of that month, as found by a full scan]
+# Abandoned approvals/edits expire instead of accumulating forever
+pending_expenses = TTLCache(maxsize=10000, ttl=3600)
+user_states = TTLCache(maxsize=10000, ttl=1800)
+parse_path_counts = {'regex': 0, 'ai': 0}  # for tuning the confidence gate
+pending_writes = {}  # user_id -> rows waiting for the next batched append
+pending_writes_lock = threading.Lock()  # flushes run in a worker thread
+write_attempts = {}  # user_id -> failed flushes of the rows now queued
+google_client = None
+sheet_cache = {}  # user_id -> (opened_at, worksheet)
+
+# Seconds between batched sheet writes
+WRITE_FLUSH_INTERVAL = 2
+# A user's queued rows are dead-lettered after this many failed flushes (or one permanent error)
+WRITE_MAX_ATTEMPTS = 5
+DEAD_LETTER_FILE = 'failed_writes.jsonl'
+# Number of distinct AI expense parses kept in memory
+AI_CACHE_SIZE = 2048
+# Pooled keep-alive connections shared by all Sheets requests
+SHEETS_POOL_SIZE = 32
+# Seconds an opened worksheet handle is reused before reopening
+SHEET_CACHE_TTL = 600
+# Screenshots are downscaled to this long edge before OCR; text stays legible
+OCR_MAX_SIZE = 1024
+# Smallest Telegram photo size worth downloading for OCR
+OCR_MIN_PHOTO_SIZE = 800
+# Phone screenshots are portrait and tall
+SCREENSHOT_MIN_HEIGHT = 600
+SCREENSHOT_MAX_ASPECT = 1.2
+# Text needs dark strokes on a light background (or the reverse) somewhere in the image
+SCREENSHOT_MIN_CONTRAST = 128
+# Other shapes only go to OCR with a large flat UI region; natural photos rarely have one
+SCREENSHOT_MIN_FLAT_SHARE = 0.2
 
 # Conversation states
 ADDING_CATEGORY, EDITING_EXPENSE, ADMIN_APPROVAL = range(3)
 
 # Default categories
 DEFAULT_CATEGORIES = {
-    'food': {'keywords': ['zomato', 'swiggy', 'restaurant', 'food', 'lunch', 'dinner', 'breakfast'], 'emoji': '🍽️'},
-    'transport': {'keywords': ['uber', 'ola', 'petrol', 'taxi', 'metro', 'bus', 'train'], 'emoji': '🚗'},
-    'shopping': {'keywords': ['amazon', 'flipkart', 'shopping', 'mall', 'clothes'], 'emoji': '🛒'},
-    'groceries': {'keywords': ['grocery', 'vegetables', 'milk', 'fruits', 'supermarket'], 'emoji': '🥕'},
-    'medical': {'keywords': ['hospital', 'doctor', 'medicine', 'pharmacy'], 'emoji': '💊'},
-    'entertainment': {'keywords': ['movie', 'cinema', 'game', 'music', 'netflix'], 'emoji': '🎬'},
-    'utilities': {'keywords': ['electricity', 'water', 'gas', 'internet', 'mobile'], 'emoji': '⚡'},
-    'miscellaneous': {'keywords': [], 'emoji': '📝'}
+    'food': {'keywords': frozenset({'zomato', 'swiggy', 'restaurant', 'food', 'lunch', 'dinner', 'breakfast'}), 'emoji': '🍽️'},
+    'transport': {'keywords': frozenset({'uber', 'ola', 'petrol', 'taxi', 'metro', 'bus', 'train'}), 'emoji': '🚗'},
+    'shopping': {'keywords': frozenset({'amazon', 'flipkart', 'shopping', 'mall', 'clothes'}), 'emoji': '🛒'},
+    'groceries': {'keywords': frozenset({'grocery', 'vegetables', 'milk', 'fruits', 'supermarket'}), 'emoji': '🥕'},
+    'medical': {'keywords': frozenset({'hospital', 'doctor', 'medicine', 'pharmacy'}), 'emoji': '💊'},
+    'entertainment': {'keywords': frozenset({'movie', 'cinema', 'game', 'music', 'netflix'}), 'emoji': '🎬'},
+    'utilities': {'keywords': frozenset({'electricity', 'water', 'gas', 'internet', 'mobile'}), 'emoji': '⚡'},
+    'miscellaneous': {'keywords': frozenset(), 'emoji': '📝'}
 }
 
+# Precompiled expense patterns (compiled once at import, not per message)
+# All amount forms are fused into one alternation so the text is scanned once;
+# exactly one group participates in a match, so match.lastindex identifies it.
+AMOUNT_RE = re.compile(
+    r'₹\s*(\d+(?:\.\d{2})?)'
+    r'|rs\.?\s*(\d+(?:\.\d{2})?)'
+    r'|(\d+(?:\.\d{2})?)\s*rupees?'
+    r'|paid\s+(\d+(?:\.\d{2})?)'
+)
+# Group 1 = UPI apps, group 2 = card keywords; the earliest keyword decides
+PAYMENT_RE = re.compile(r'(paytm|gpay|phonepe|upi)|(card|credit|debit)')
+# Run on the lowercased text; the merchant is title-cased afterwards anyway.
+# Word-anchored with possessive quantifiers (Python 3.11+) so a failed match
+# never backtracks through the name; the second form takes a single word.
+MERCHANT_RES = [re.compile(p) for p in (
+    r'\b(?:at|from|to)\s+([a-z][a-z0-9\s&.,-]{2,30}+)',
+    r'\b([a-z][a-z0-9&.,-]{2,30}+)\s++(?:₹|rs|paid)'
+)]
+
+def loads_json(data):
+    """Parse JSON with orjson when available, else the stdlib"""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps_json(obj, indent=False):
+    """Serialize JSON to str with orjson when available, else the stdlib"""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0).decode()
+    return json.dumps(obj, indent=2 if indent else None)
+
+def get_db():
+    """Open the SQLite store, creating tables on first use (call with db_lock held)"""
+    global db
+    if db is None:
+        db = sqlite3.connect(DB_FILE, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS user_sheets (user_id TEXT PRIMARY KEY, sheet_id TEXT NOT NULL)')
+        db.execute('CREATE TABLE IF NOT EXISTS user_categories ('
+                   'user_id TEXT, cat_name TEXT, keywords_json TEXT, emoji TEXT, '
+                   'PRIMARY KEY (user_id, cat_name))')
+        db.commit()
+    return db
+
 def load_users():
-    """Load user data from JSON file"""
+    """Load user sheet IDs from the database"""
     global user_sheets
     try:
-        if os.path.exists(USERS_FILE):
-            with open(USERS_FILE, 'r') as f:
-                user_sheets = json.load(f)
+        with db_lock:
+            conn = get_db()
+            user_sheets = dict(conn.execute('SELECT user_id, sheet_id FROM user_sheets'))
+            if not user_sheets and os.path.exists(USERS_FILE):
+                with open(USERS_FILE, 'r') as f:
+                    user_sheets = loads_json(f.read())
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO user_sheets VALUES (?, ?)', user_sheets.items())
     except Exception as e:
         logger.error(f"Error loading users: {e}")
         user_sheets = {}
 
-def save_users():
-    """Save user data to JSON file"""
+def save_users(user_id):
+    """Save one user's sheet ID to the database"""
+    user_id_str = str(user_id)
     try:
-        with open(USERS_FILE, 'w') as f:
-            json.dump(user_sheets, f, indent=2)
+        with db_lock, get_db() as conn:
+            conn.execute('INSERT OR REPLACE INTO user_sheets VALUES (?, ?)',
+                         (user_id_str, user_sheets[user_id_str]))
     except Exception as e:
         logger.error(f"Error saving users: {e}")
 
 def load_categories():
-    """Load user categories from JSON file"""
+    """Load user categories from the database"""
     global user_categories
     try:
-        if os.path.exists(CATEGORIES_FILE):
+        with db_lock:
+            rows = get_db().execute(
+                'SELECT user_id, cat_name, keywords_json, emoji FROM user_categories ORDER BY rowid').fetchall()
+        user_categories = {}
+        for user_id, cat, keywords_json, emoji in rows:
+            user_categories.setdefault(user_id, {})[cat] = {'keywords': frozenset(loads_json(keywords_json)), 'emoji': emoji}
+        if not user_categories and os.path.exists(CATEGORIES_FILE):
             with open(CATEGORIES_FILE, 'r') as f:
-                user_categories = json.load(f)
-        else:
-            user_categories = {}
+                user_categories = loads_json(f.read())
+            for user_id, categories in user_categories.items():
+                for cat_data in categories.values():
+                    cat_data['keywords'] = frozenset(cat_data['keywords'])
+                save_categories(user_id)
     except Exception as e:
         logger.error(f"Error loading categories: {e}")
         user_categories = {}
 
-def save_categories():
-    """Save user categories to JSON file"""
+def save_categories(user_id):
+    """Save one user's categories to the database"""
+    user_id_str = str(user_id)
+    # Categories may have changed, so the compiled keyword matcher is stale
+    user_category_matchers.pop(user_id_str, None)
     try:
-        with open(CATEGORIES_FILE, 'w') as f:
-            json.dump(user_categories, f, indent=2)
+        with db_lock, get_db() as conn:
+            conn.execute('DELETE FROM user_categories WHERE user_id = ?', (user_id_str,))
+            conn.executemany(
+                'INSERT INTO user_categories VALUES (?, ?, ?, ?)',
+                [(user_id_str, cat, dumps_json(sorted(cat_data['keywords'])), cat_data.get('emoji', '📝'))
+                 for cat, cat_data in user_categories.get(user_id_str, {}).items()]
+            )
     except Exception as e:
         logger.error(f"Error saving categories: {e}")
 
+def load_month_index():
+    """Load per-user month start rows from JSON file"""
+    global month_index
+    try:
+        if os.path.exists(MONTH_INDEX_FILE):
+            with open(MONTH_INDEX_FILE, 'r') as f:
+                month_index = loads_json(f.read())
+    except Exception as e:
+        logger.error(f"Error loading month index: {e}")
+        month_index = {}
+
+def save_month_index():
+    """Save per-user month start rows to JSON file"""
+    try:
+        with open(MONTH_INDEX_FILE, 'w') as f:
+            f.write(dumps_json(month_index, indent=True))
+    except Exception as e:
+        logger.error(f"Error saving month index: {e}")
+
+def record_month_start(user_id, month, row_number):
+    """Remember the first sheet row of a month found by scanning the whole sheet"""
+    if month_index.get(str(user_id)) != [month, row_number]:
+        month_index[str(user_id)] = [month, row_number]
+        save_month_index()
+
+def row_in_month(row, month):
+    """Whether a sheet row (possibly empty) is dated in the given YYYY-MM month"""
+    return bool(row) and str(row[0]).startswith(month)
+
 def get_user_categories(user_id):
     """Get categories for a specific user"""
     user_id_str = str(user_id)
     if user_id_str not in user_categories:
-        user_categories[user_id_str] = DEFAULT_CATEGORIES.copy()
-        save_categories()
+        # Fresh dicts per user; the frozen keyword sets are shared with the template.
+        # Defaults aren't persisted - rows are only written once the user customizes.
+        user_categories[user_id_str] = {
+            cat: {'keywords': cat_data['keywords'], 'emoji': cat_data['emoji']}
+            for cat, cat_data in DEFAULT_CATEGORIES.items()
+        }
     return user_categories[user_id_str]
 
+def build_category_matcher(categories):
+    """Compile a user's keywords into one regex plus a keyword -> category index"""
+    keyword_to_cat = {}
+    for cat, cat_data in categories.items():
+        for keyword in cat_data['keywords']:
+            if keyword:
+                keyword_to_cat.setdefault(keyword, cat)
+    if not keyword_to_cat:
+        return None, keyword_to_cat
+    # Longest first so a keyword is never shadowed by one of its prefixes
+    keywords = sorted(keyword_to_cat, key=len, reverse=True)
+    return re.compile('|'.join(re.escape(k) for k in keywords)), keyword_to_cat
+
+def get_category_matcher(user_id):
+    """Get the cached keyword matcher for a user, building it on first use"""
+    user_id_str = str(user_id)
+    matcher = user_category_matchers.get(user_id_str)
+    if matcher is None:
+        matcher = build_category_matcher(get_user_categories(user_id))
+        user_category_matchers[user_id_str] = matcher
+    return matcher
+
+_today_cache = [0.0, '']  # [refreshed_at, 'YYYY-MM-DD']
+
+def today():
+    """Today's date string, reformatted at most once a minute"""
+    now = time.time()
+    if now - _today_cache[0] > 60:
+        _today_cache[:] = [now, datetime.now().strftime('%Y-%m-%d')]
+    return _today_cache[1]
+
 def extract_with_regex(text, user_id):
     """Extract expense information using regex patterns"""
     text_lower = text.lower()
     
     # Extract amount
     amount = None
-    for pattern in [r'₹\s*(\d+(?:\.\d{2})?)', r'rs\.?\s*(\d+(?:\.\d{2})?)', 
-                   r'(\d+(?:\.\d{2})?)\s*rupees?', r'paid\s+(\d+(?:\.\d{2})?)']:
-        match = re.search(pattern, text_lower)
-        if match:
-            amount = float(match.group(1))
-            break
+    match = AMOUNT_RE.search(text_lower)
+    if match:
+        amount = float(match.group(match.lastindex))
     
     # Extract payment method
     payment_method = 'cash'
-    if any(k in text_lower for k in ['paytm', 'gpay', 'phonepe', 'upi']):
-        payment_method = 'upi'
-    elif any(k in text_lower for k in ['card', 'credit', 'debit']):
-        payment_method = 'card'
+    match = PAYMENT_RE.search(text_lower)
+    if match:
+        payment_method = 'upi' if match.group(1) else 'card'
     
     # Extract merchant
     merchant = 'Unknown'
-    for pattern in [r'(?:at|from|to)\s+([a-zA-Z][a-zA-Z0-9\s&.,-]{2,30})', 
-                   r'([a-zA-Z][a-zA-Z0-9\s&.,-]{2,30})\s+(?:₹|rs|paid)']:
-        match = re.search(pattern, text, re.IGNORECASE)
+    for pattern in MERCHANT_RES:
+        match = pattern.search(text_lower)
         if match:
             candidate = match.group(1).strip().title()
             if len(candidate) > 2:
@@ -125,12 +296,12 @@ def extract_with_regex(text, user_id):
                 break
     
     # Extract category using user's custom categories
-    categories = get_user_categories(user_id)
     category = 'miscellaneous'
-    for cat, cat_data in categories.items():
-        if any(keyword in text_lower for keyword in cat_data['keywords']):
-            category = cat
-            break
+    pattern, keyword_to_cat = get_category_matcher(user_id)
+    if pattern:
+        match = pattern.search(text_lower)
+        if match:
+            category = keyword_to_cat[match.group()]
     
     return {
         'amount': amount, 
@@ -138,11 +309,14 @@ def extract_with_regex(text, user_id):
         'payment_method': payment_method,
         'description': text[:50], 
         'merchant': merchant, 
-        'date': datetime.now().strftime('%Y-%m-%d')
+        'date': today()
     }
 
 def get_google_client():
-    """Initialize Google Sheets client"""
+    """Get the shared Google Sheets client, authorizing on first use"""
+    global google_client
+    if google_client:
+        return google_client
     try:
         scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
         
@@ -166,21 +340,41 @@ def get_google_client():
             creds = Credentials.from_service_account_file('telegram_service_account.json', scopes=scope)
             logger.info("✅ Google Sheets initialized from local file")
             
-        return gspread.authorize(creds)
+        # One pooled, kept-alive session so requests reuse TLS connections
+        session = AuthorizedSession(creds)
+        session.mount('https://', HTTPAdapter(pool_connections=SHEETS_POOL_SIZE, pool_maxsize=SHEETS_POOL_SIZE))
+        google_client = gspread.Client(auth=creds, session=session)
+        return google_client
     except Exception as e:
         logger.error(f"Google client error: {e}")
         return None
 
+def drop_cached_sheet(user_id, error=None):
+    """Forget a cached worksheet after an API error (and the client on 401)"""
+    global google_client
+    if isinstance(error, gspread.exceptions.APIError):
+        status = error.response.status_code
+        if status in (401, 404):
+            sheet_cache.pop(str(user_id), None)
+        if status == 401:
+            google_client = None
+
 def get_user_sheet(user_id):
     """Get or create user's Google Sheet"""
     try:
+        cached = sheet_cache.get(str(user_id))
+        if cached and time.monotonic() - cached[0] < SHEET_CACHE_TTL:
+            return cached[1]
+        
         gc = get_google_client()
         if not gc: 
             return None
             
         if str(user_id) in user_sheets:
             try:
-                return gc.open_by_key(user_sheets[str(user_id)]).sheet1
+                sheet = gc.open_by_key(user_sheets[str(user_id)]).sheet1
+                sheet_cache[str(user_id)] = (time.monotonic(), sheet)
+                return sheet
             except: 
                 pass
         
@@ -193,7 +387,7 @@ def get_user_sheet(user_id):
         
         # Store sheet ID
         user_sheets[str(user_id)] = spreadsheet.id
-        save_users()
+        save_users(user_id)
         
         # Share with user if email is available (optional)
         try:
@@ -201,47 +395,91 @@ def get_user_sheet(user_id):
         except:
             pass
             
+        sheet_cache[str(user_id)] = (time.monotonic(), sheet)
         return sheet
     except Exception as e:
         logger.error(f"Sheet error: {e}")
         return None
 
-async def parse_expense_ai(text, user_id):
-    """Parse expense using AI with user's custom categories"""
-    try:
-        categories = get_user_categories(user_id)
-        category_list = list(categories.keys())
-        
-        prompt = f"""Parse this expense text: "{text}"
+@functools.lru_cache(maxsize=AI_CACHE_SIZE)
+def parse_expense_ai_cached(text, category_list, today):
+    """Ask Gemini to parse an expense; memoized so repeated inputs skip the call"""
+    prompt = f"""Parse this expense text: "{text}"
         
 Available categories: {', '.join(category_list)}
 
 Return ONLY valid JSON in this exact format:
-{{"amount": number, "category": "one_of_the_categories_above", "description": "brief description", "merchant": "merchant name", "payment_method": "upi|cash|card", "date": "{datetime.now().strftime('%Y-%m-%d')}"}}
+{{"amount": number, "category": "one_of_the_categories_above", "description": "brief description", "merchant": "merchant name", "payment_method": "upi|cash|card", "date": "{today}"}}
 
 Choose the most appropriate category from the list above."""
-        
-        response = model.generate_content(prompt)
-        result = response.text.strip()
-        
-        # Clean up the response
-        if '```json' in result: 
-            result = result.split('```json')[1].split('```')[0].strip()
-        elif '```' in result: 
-            result = result.split('```')[1].split('```')[0].strip()
-        
-        return json.loads(result)
+    
+    response = model.generate_content(prompt)
+    result = response.text.strip()
+    
+    # Clean up the response: keep the first fenced block, if any
+    _, fence, rest = result.partition('```')
+    if fence:
+        result, _, _ = rest.partition('```')
+        result = result.removeprefix('json').strip()
+    
+    # Validate before caching; callers parse their own copy
+    loads_json(result)
+    return result
+
+async def parse_expense_ai(text, user_id):
+    """Parse expense using AI with user's custom categories"""
+    try:
+        categories = get_user_categories(user_id)
+        # Normalized text + category set + date is the cache key
+        result = await asyncio.to_thread(
+            parse_expense_ai_cached,
+            ' '.join(text.split()),
+            tuple(sorted(categories)),
+            today()
+        )
+        return loads_json(result)
     except Exception as e:
         logger.error(f"AI parsing error: {e}")
         return None
 
-def clean_ocr_text(image_bytes):
+def looks_like_screenshot(image_file):
+    """Cheap check before OCR; only False for images that clearly aren't screenshots"""
+    try:
+        image_file.seek(0)
+        image = Image.open(image_file)
+        width, height = image.size
+        # Full resolution: a downsample can skip every pixel of thin text strokes
+        gray = image.convert('L')
+        low, high = gray.getextrema()
+        if high - low < SCREENSHOT_MIN_CONTRAST:
+            return False
+        if height >= SCREENSHOT_MIN_HEIGHT and width / height <= SCREENSHOT_MAX_ASPECT:
+            # Portrait: gradient or photo backgrounds are common in payment apps, so OCR it
+            return True
+        
+        # Share of pixels in the most common gray level; natural photos rarely have one
+        histogram = gray.histogram()
+        return max(histogram) / sum(histogram) >= SCREENSHOT_MIN_FLAT_SHARE
+    except Exception as e:
+        logger.error(f"Screenshot check error: {e}")
+        return True
+
+def clean_ocr_text(image_file):
     """Extract text from UPI screenshot using OCR"""
     try:
-        image = Image.open(BytesIO(image_bytes))
+        image_file.seek(0)
+        image = Image.open(image_file)
+        
+        # Downscale and re-encode so far fewer bytes go over the wire to Gemini
+        image.thumbnail((OCR_MAX_SIZE, OCR_MAX_SIZE), Image.LANCZOS)
+        buffer = BytesIO()
+        image.convert('RGB').save(buffer, 'JPEG', quality=85, optimize=True)
+        buffer.seek(0)
+        ocr_image = Image.open(buffer)
+        
         response = model.generate_content([
             "Extract all payment details from this image including amounts, merchant names, payment method, and any other transaction details. Be very detailed:", 
-            image
+            ocr_image
         ])
         return response.text.strip()
     except Exception as e:
@@ -249,12 +487,8 @@ def clean_ocr_text(image_bytes):
         return None
 
 def add_expense_to_sheet(user_id, expense_data, status="Confirmed"):
-    """Add expense to Google Sheet"""
+    """Queue expense for the next batched Google Sheet write"""
     try:
-        sheet = get_user_sheet(user_id)
-        if not sheet: 
-            return False
-            
         row = [
             expense_data['date'], 
             expense_data['amount'], 
@@ -264,12 +498,73 @@ def add_expense_to_sheet(user_id, expense_data, status="Confirmed"):
             expense_data.get('merchant', 'Unknown'),
             status
         ]
-        sheet.append_row(row)
+        with pending_writes_lock:
+            pending_writes.setdefault(user_id, []).append(row)
         return True
     except Exception as e:
         logger.error(f"Sheet add error: {e}")
         return False
 
+def is_retryable_write_error(error):
+    """Client errors other than timeouts and quota won't succeed on a retry"""
+    if isinstance(error, gspread.exceptions.APIError):
+        status = error.response.status_code
+        return not (400 <= status < 500) or status in (408, 429)
+    return True
+
+def dead_letter_rows(user_id, rows, error):
+    """Give up on rows that can't be written, keeping them in DEAD_LETTER_FILE"""
+    logger.error(f"Dropping {len(rows)} row(s) for user {user_id} after: {error}")
+    try:
+        with open(DEAD_LETTER_FILE, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'user_id': str(user_id), 'failed_at': datetime.now().isoformat(),
+                                'error': str(error), 'rows': rows}, default=str) + '\n')
+    except OSError as e:
+        logger.error(f"Dead-letter write error: {e}")
+
+def flush_pending_writes():
+    """Write all queued rows with a single append_rows call per user"""
+    with pending_writes_lock:
+        batches = dict(pending_writes)
+        pending_writes.clear()
+    for user_id, rows in batches.items():
+        try:
+            sheet = get_user_sheet(user_id)
+            if not sheet:
+                raise RuntimeError("sheet unavailable")
+            # Appended rows land after the recorded month start, so they never move it. The start
+            # itself is only taken from a full scan: rows can carry out-of-order (AI/screenshot) dates
+            sheet.append_rows(rows, value_input_option='USER_ENTERED')
+        except Exception as e:
+            logger.error(f"Sheet flush error: {e}")
+            drop_cached_sheet(user_id, e)
+            with pending_writes_lock:
+                attempts = write_attempts.get(user_id, 0) + 1
+                if is_retryable_write_error(e) and attempts < WRITE_MAX_ATTEMPTS:
+                    write_attempts[user_id] = attempts
+                    # Put the rows back in front of anything queued meanwhile
+                    pending_writes[user_id] = rows + pending_writes.get(user_id, [])
+                    continue
+                write_attempts.pop(user_id, None)
+            dead_letter_rows(user_id, rows, e)
+        else:
+            with pending_writes_lock:
+                write_attempts.pop(user_id, None)
+
+async def flush_writes_periodically():
+    """Background task that flushes queued sheet writes"""
+    while True:
+        await asyncio.sleep(WRITE_FLUSH_INTERVAL)
+        await asyncio.to_thread(flush_pending_writes)
+
+async def start_write_flusher(app):
+    """Start the batched sheet writer once the application is initialized"""
+    app.create_task(flush_writes_periodically())
+
+async def stop_write_flusher(app):
+    """Flush whatever is still queued before shutting down"""
+    await asyncio.to_thread(flush_pending_writes)
+
 def create_approval_keyboard(expense_id):
     """Create keyboard for expense approval"""
     return InlineKeyboardMarkup([
@@ -300,11 +595,17 @@ def create_edit_keyboard(expense_id):
 def create_category_keyboard(user_id):
     """Create keyboard for category selection"""
     categories = get_user_categories(user_id)
+    return build_category_keyboard(
+        tuple((cat, cat_data.get('emoji', '📝')) for cat, cat_data in categories.items())
+    )
+
+@functools.lru_cache(maxsize=256)
+def build_category_keyboard(category_items):
+    """Build the category keyboard once per distinct (category, emoji) set"""
     keyboard = []
     row = []
     
-    for cat, cat_data in categories.items():
-        emoji = cat_data.get('emoji', '📝')
+    for cat, emoji in category_items:
         button = InlineKeyboardButton(f"{emoji} {cat.title()}", callback_data=f"cat_{cat}")
         row.append(button)
         
@@ -318,13 +619,14 @@ def create_category_keyboard(user_id):
     keyboard.append([InlineKeyboardButton("➕ Add New Category", callback_data="add_category")])
     return InlineKeyboardMarkup(keyboard)
 
+MAIN_MENU_KEYBOARD = ReplyKeyboardMarkup([
+    [KeyboardButton("📊 View Sheet"), KeyboardButton("📂 Manage Categories")],
+    [KeyboardButton("📈 Monthly Summary"), KeyboardButton("❓ Help")]
+], resize_keyboard=True)
+
 def create_main_menu_keyboard():
     """Create main menu keyboard"""
-    keyboard = [
-        [KeyboardButton("📊 View Sheet"), KeyboardButton("📂 Manage Categories")],
-        [KeyboardButton("📈 Monthly Summary"), KeyboardButton("❓ Help")]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    return MAIN_MENU_KEYBOARD
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Welcome message and user onboarding"""
@@ -368,7 +670,7 @@ Ready to start tracking? Send me your first expense! 💰
     # Initialize user data
     user_id = user.id
     get_user_categories(user_id)  # Initialize with default categories
-    get_user_sheet(user_id)  # Create sheet if doesn't exist
+    await asyncio.to_thread(get_user_sheet, user_id)  # Create sheet if doesn't exist
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show help information"""
@@ -450,30 +752,50 @@ async def monthly_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     try:
-        sheet = get_user_sheet(user_id)
+        sheet = await asyncio.to_thread(get_user_sheet, user_id)
         if not sheet:
             await update.message.reply_text("❌ Error accessing your expense sheet.")
             return
         
         # Get current month data
         current_month = datetime.now().strftime('%Y-%m')
-        all_records = sheet.get_all_records()
         
-        # Filter current month expenses
-        month_expenses = [r for r in all_records if r['Date'].startswith(current_month)]
+        # Only download rows from the start of the current month when known. The row before
+        # it is fetched too: if that one is in this month, or the start row isn't, rows were
+        # deleted, inserted or sorted since, and the whole sheet is scanned again instead
+        rows = None
+        entry = month_index.get(str(user_id))
+        if entry and entry[0] == current_month and entry[1] > 2:
+            start_row = entry[1]
+            fetched = await asyncio.to_thread(sheet.get, f'A{start_row - 1}:G')
+            if (len(fetched) > 1 and not row_in_month(fetched[0], current_month)
+                    and row_in_month(fetched[1], current_month)):
+                rows = fetched[1:]
+        full_scan = rows is None
+        if full_scan:
+            start_row = 2
+            rows = await asyncio.to_thread(sheet.get, 'A2:G')
+        
+        # Filter current month expenses (columns: Date, Amount, Category, ...)
+        month_expenses = []
+        for offset, row in enumerate(rows):
+            if len(row) >= 3 and row_in_month(row, current_month):
+                if full_scan and not month_expenses:
+                    record_month_start(user_id, current_month, start_row + offset)
+                month_expenses.append(row)
         
         if not month_expenses:
             await update.message.reply_text(f"📊 No expenses found for {current_month}")
             return
         
         # Calculate summary
-        total_amount = sum(float(r['Amount (₹)']) for r in month_expenses)
+        total_amount = sum(float(r[1]) for r in month_expenses)
         categories = get_user_categories(user_id)
         
         category_totals = {}
         for expense in month_expenses:
-            cat = expense['Category']
-            category_totals[cat] = category_totals.get(cat, 0) + float(expense['Amount (₹)'])
+            cat = expense[2]
+            category_totals[cat] = category_totals.get(cat, 0) + float(expense[1])
         
         # Create summary message
         summary = f"""
@@ -496,6 +818,7 @@ async def monthly_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     except Exception as e:
         logger.error(f"Summary error: {e}")
+        drop_cached_sheet(user_id, e)
         await update.message.reply_text("❌ Error generating summary.")
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -523,12 +846,21 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Try regex first
     expense_data = extract_with_regex(text, user_id)
     
-    # If regex fails, use AI
-    if not expense_data['amount']:
-        expense_data = await parse_expense_ai(text, user_id)
+    # Accept the regex result only when it found every field; otherwise use AI
+    confident = (expense_data['amount'] and expense_data['merchant'] != 'Unknown'
+                 and expense_data['category'] != 'miscellaneous')
+    if confident:
+        parse_path_counts['regex'] += 1
+    else:
+        parse_path_counts['ai'] += 1
+        ai_data = await parse_expense_ai(text, user_id)
+        # Keep a partial regex result if the AI can't parse it either
+        if ai_data and ai_data.get('amount'):
+            expense_data = ai_data
+    logger.info(f"Expense parse paths so far: {parse_path_counts}")
     
     if expense_data and expense_data.get('amount'):
-        expense_id = f"exp_{user_id}_{int(datetime.now().timestamp())}"
+        expense_id = f"exp_{user_id}_{secrets.token_hex(6)}"
         pending_expenses[expense_id] = expense_data
         
         categories = get_user_categories(user_id)
@@ -566,12 +898,22 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("📸 Reading your screenshot...")
         
         # Download image
-        photo = update.message.photo[-1]
+        # Smallest size that is still big enough to read; sizes are ascending
+        photo = next(
+            (p for p in update.message.photo if max(p.width, p.height) >= OCR_MIN_PHOTO_SIZE),
+            update.message.photo[-1]
+        )
         file = await context.bot.get_file(photo.file_id)
-        image_bytes = await file.download_as_bytearray()
+        # Download straight into one buffer that both image checks read from
+        image_file = BytesIO()
+        await file.download_to_memory(image_file)
+        
+        if not looks_like_screenshot(image_file):
+            await update.message.reply_text("🤔 This doesn't look like a payment screenshot. Please send a UPI payment screenshot or type the expense.")
+            return
         
         # Extract text using OCR
-        extracted_text = clean_ocr_text(image_bytes)
+        extracted_text = clean_ocr_text(image_file)
         
         if extracted_text:
             await update.message.reply_text(f"📝 Extracted text:\n{extracted_text[:200]}...")
@@ -580,7 +922,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             expense_data = await parse_expense_ai(extracted_text, user_id)
             
             if expense_data and expense_data.get('amount'):
-                expense_id = f"exp_{user_id}_{int(datetime.now().timestamp())}"
+                expense_id = f"exp_{user_id}_{secrets.token_hex(6)}"
                 pending_expenses[expense_id] = expense_data
                 
                 categories = get_user_categories(user_id)
@@ -619,10 +961,19 @@ Please review and approve:
         logger.error(f"Photo processing error: {e}")
         await update.message.reply_text("❌ Error processing image. Please try again.")
 
+def take_pending_expense(expense_id, keep=False):
+    """Read (and unless keep, remove) a pending expense in one step; None once it is gone or expired"""
+    # A separate "in" check and read can straddle the TTL, and the read then raises KeyError
+    try:
+        return pending_expenses[expense_id] if keep else pending_expenses.pop(expense_id)
+    except KeyError:
+        return None
+
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle button callbacks"""
     query = update.callback_query
-    await query.answer()
+    # Acknowledge the tap concurrently with the work below instead of waiting on it first
+    context.application.create_task(query.answer(), update=update)
     
     data = query.data
     
@@ -630,12 +981,12 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith(("approve_", "edit_", "reject_")):
         action, expense_id = data.split('_', 1)
         
-        if expense_id not in pending_expenses:
+        # Approve and reject take the expense out up front, so a second tap finds it gone
+        expense_data = take_pending_expense(expense_id, keep=action == "edit")
+        if expense_data is None:
             await query.edit_message_text("❌ Expense session expired.")
             return
         
-        expense_data = pending_expenses[expense_id]
-        
         if action == "approve":
             if add_expense_to_sheet(query.from_user.id, expense_data, "Approved"):
                 await query.edit_message_text(
@@ -646,7 +997,6 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
             else:
                 await query.edit_message_text("❌ Error saving to sheet.")
-            del pending_expenses[expense_id]
             
         elif action == "edit":
             user_states[query.from_user.id] = {'editing': expense_id}
@@ -661,7 +1011,6 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             
         elif action == "reject":
-            del pending_expenses[expense_id]
             await query.edit_message_text("❌ Expense rejected and deleted.")
     
     # Handle edit actions
@@ -686,8 +1035,8 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data.startswith(("save_", "cancel_")):
         action, expense_id = data.split('_', 1)
         
-        if action == "save" and expense_id in pending_expenses:
-            expense_data = pending_expenses[expense_id]
+        expense_data = take_pending_expense(expense_id)
+        if action == "save" and expense_data is not None:
             if add_expense_to_sheet(query.from_user.id, expense_data, "Edited & Approved"):
                 await query.edit_message_text(
                     f"✅ **Expense Saved!**\n\n"
@@ -697,10 +1046,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
             else:
                 await query.edit_message_text("❌ Error saving to sheet.")
-            del pending_expenses[expense_id]
         else:
-            if expense_id in pending_expenses:
-                del pending_expenses[expense_id]
             await query.edit_message_text("❌ Operation cancelled.")
         
         # Clear user state
@@ -725,9 +1071,11 @@ def main():
     # Load data
     load_users()
     load_categories()
+    load_month_index()
     
     # Create application
-    app = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
+    app = (Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN'))
+           .post_init(start_write_flusher).post_shutdown(stop_write_flusher).build())
     
     # Add handlers
     app.add_handler(CommandHandler("start", start))
@@ -744,9 +1092,11 @@ def main():
     """Main function to run the bot"""
     load_users()
     load_categories()
+    load_month_index()
     
     # Initialize bot
-    app = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
+    app = (Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN'))
+           .post_init(start_write_flusher).post_shutdown(stop_write_flusher).build())
     
     # Add handlers
     app.add_handler(CommandHandler("start", start))
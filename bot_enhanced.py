@@ -1,66 +1,230 @@
-import os, json, logging, re, traceback, uuid
-from datetime import datetime, timedelta
+import os, json, logging, re, threading, time, functools, shutil, itertools, queue, atexit, sqlite3, copy, heapq, html, sys
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from dataclasses import dataclass, field
+from datetime import datetime
+from collections import OrderedDict, Counter
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from telegram.constants import ParseMode
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes, ConversationHandler
 import google.generativeai as genai
 import gspread
 from google.oauth2.service_account import Credentials
 from PIL import Image
+from rapidfuzz import fuzz, process
 from dotenv import load_dotenv
 import asyncio
+from env_config import validate_env, data_file_path
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging with more detailed format
-log_filename = f"logs/bot_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+# Configure logging with more detailed format. Handlers write from a background
+# listener thread so logging never blocks the event loop on disk I/O.
+log_filename = 'logs/bot.log'
 os.makedirs('logs', exist_ok=True)
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler(log_filename, encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_handlers = [
+    RotatingFileHandler(log_filename, maxBytes=10_000_000, backupCount=5, encoding='utf-8'),
+    logging.StreamHandler()
+]
+for log_handler in log_handlers:
+    log_handler.setFormatter(log_formatter)
+
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(log_queue, *log_handlers)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
 logger = logging.getLogger(__name__)
 
-# Configure Gemini AI
-try:
-    genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    logger.info("✅ Gemini AI configured successfully")
-except Exception as e:
-    logger.error(f"❌ Gemini configuration failed: {e}")
-    raise
+def env_float_clamped(name, default, low, high):
+    """Read a float setting from the environment, falling back to default and clamping to [low, high]"""
+    try:
+        value = float(os.getenv(name, default))
+    except ValueError:
+        logger.error(f"❌ Invalid {name}, using {default}")
+        value = default
+    return min(max(value, low), high)
+
+# Gemini AI model, configured on first use rather than at import
+model = None
+model_lock = threading.Lock()
+
+def get_model():
+    """Get the shared Gemini model, configuring the client on first use"""
+    global model
+    if model:
+        return model
+    with model_lock:
+        if not model:
+            try:
+                genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+                model = genai.GenerativeModel('gemini-1.5-flash')
+                logger.info("✅ Gemini AI configured successfully")
+            except Exception as e:
+                logger.error(f"❌ Gemini configuration failed: {e}")
+                raise
+    return model
+
+# Concurrent Gemini requests are capped to stay inside the API quota
+GEMINI_MAX_CONCURRENCY = 8
+gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+async def gemini_generate(contents):
+    """Run a blocking Gemini generate_content call on a worker thread, bounded by the quota semaphore"""
+    async with gemini_semaphore:
+        return await asyncio.to_thread(get_model().generate_content, contents)
 
 # File paths and global variables
 USERS_FILE = 'users.json'
 CATEGORIES_FILE = 'categories.json'
+# Rolling backups kept per data file: users.json.bak.0 (newest) .. .bak.2
+BACKUP_COUNT = 3
+# Data files changed since the last flush; written together by the background flusher
+dirty_files = set()
+# Only one writer rotates backups and swaps data files at a time
+save_lock = threading.Lock()
+AGGREGATES_FILE = 'user_aggregates.json'
 user_sheets = {}
 user_categories = {}
-pending_expenses = {}
+# Running spend totals per user, updated as rows are written so summaries rarely scan the sheet:
+# {user_id: {'sheet_id', 'built_at', 'totals': {'YYYY-MM' or '_all': {'total', 'count', 'category': {...}, 'payment_method': {...}}}}}
+# Totals belong to the sheet they were built from and are rebuilt after AGGREGATES_TTL, which
+# picks up rows users edit or delete by hand in the sheet
+user_aggregates = {}
+AGGREGATES_TTL = 6 * 3600
+# Guards user_aggregates and aggregates_generation; never held across a Sheets call
+aggregates_lock = threading.Lock()
+# Per-user count of appends to the sheet, so a rebuild can tell whether rows landed while it was fetching
+aggregates_generation = {}
+# Rebuild attempts before returning totals without caching them
+AGGREGATES_REBUILD_ATTEMPTS = 3
+# Expenses awaiting approval live in STATE_DB_FILE (see StateStore) so restarts keep them
+STATE_DB_FILE = 'bot_state.db'
+PENDING_EXPENSE_TTL = 24 * 3600
+# Upper bound on stored pending expenses; the oldest are evicted first
+PENDING_EXPENSE_MAX = 10_000
+# Ids of recently approved or rejected expenses, so a repeat tap on the same buttons is ignored
+settled_expenses = OrderedDict()
+SETTLED_EXPENSES_MAX = 1000
+# Pending expenses outlive restarts, so the id counter is seeded with the clock like session ids
+expense_counter = itertools.count(int(time.time()))
 user_states = {}
+# Abandoned conversation states are dropped after this many seconds
+USER_STATE_TTL = 30 * 60
+# Upper bound on tracked conversation states; the earliest added are dropped first
+USER_STATE_MAX = 10_000
+# Seconds between sweeps of expired pending expenses, conversation states and edit sessions
+STATE_EXPIRY_INTERVAL = 60
 user_conversations = {}
+# Rows waiting for the next batched sheet write, keyed by user id
+pending_writes = {}
+pending_writes_lock = threading.Lock()
+# Failed flushes of each user's queued rows; batches that keep failing are dead-lettered
+write_attempts = {}
+WRITE_MAX_ATTEMPTS = 5
+DEAD_LETTER_FILE = 'failed_writes.jsonl'
+# Typed categories at least this similar (0-100) to an existing one are offered as a correction
+CATEGORY_MATCH_CUTOFF = 80
+# Long category names with no fuzzy match are only sent to Gemini when this is enabled
+AI_CATEGORY_MATCH = os.getenv('AI_CATEGORY_MATCH', '').lower() in ('1', 'true', 'yes')
+# Inline message edits are debounced this long so a burst only sends the last one;
+# longer messages get proportionally more time
+EDIT_DEBOUNCE = env_float_clamped('EDIT_DEBOUNCE_MS', 180, 50, 1000) / 1000
+EDIT_DEBOUNCE_LONG = EDIT_DEBOUNCE * 5 / 3
+EDIT_SHORT_TEXT_LEN = 320
+# Seconds between batched sheet writes, and the queued row count that triggers one early
+WRITE_FLUSH_INTERVAL = env_float_clamped('BATCH_FLUSH_INTERVAL', 3, 0.5, 60)
+WRITE_BUFFER_MAX = int(env_float_clamped('MAX_BUFFER_SIZE', 20, 1, 500))
+# Set when the write buffer fills up so the flusher doesn't wait out its interval
+write_flush_event = asyncio.Event()
+# Blocking gspread calls run here, capped well below the Sheets per-minute quota
+SHEETS_MAX_WORKERS = 8
+sheets_executor = ThreadPoolExecutor(max_workers=SHEETS_MAX_WORKERS, thread_name_prefix='sheets')
+# Authorized Sheets client shared by all requests, built on first use
+google_client = None
+google_client_lock = threading.Lock()
+# Opened worksheet handles per user: user_id -> (opened_at, worksheet)
+sheet_cache = {}
+# Seconds an opened worksheet handle is reused before reopening
+SHEET_CACHE_TTL = 600
+# Sheet records per user: user_id -> (fetched_at, records); dropped when new rows are written
+records_cache = {}
+RECORDS_CACHE_TTL = 90
+# Screenshots are downscaled to this long edge and re-encoded before OCR; text stays legible
+OCR_MAX_SIZE = 1280
+OCR_JPEG_QUALITY = 80
+# Gemini results for repeated prompts, least recently used evicted first
+ai_cache = OrderedDict()
+AI_CACHE_SIZE = 1024
+# Low-confidence answers are not worth replaying
+AI_CACHE_MIN_CONFIDENCE = 0.7
+# Category suggestions are reused for this long before asking Gemini again
+SUGGESTION_CACHE_TTL = 3600
 
 # Conversation states for category management and other flows
 ADDING_CATEGORY, EDITING_EXPENSE, ADMIN_APPROVAL, GENERAL_CHAT = range(4)
 ADDING_CATEGORY_NAME, ADDING_CATEGORY_EMOJI, ADDING_CATEGORY_KEYWORDS = range(3) # Sub-states for ADDING_CATEGORY
 EDITING_AMOUNT, EDITING_CATEGORY = range(2) # Sub-states for EDITING_EXPENSE
 
+@dataclass(slots=True)
+class UserState:
+    """Per-user conversation state; slots keep each instance far smaller than a dict"""
+    state: int = None
+    step: int = None
+    session_id: str = None
+    category_name: str = None
+    category_emoji: str = None
+    existing_categories: frozenset = None
+    ai_suggestions: list = None
+    pending_category_confirmation: str = None
+    suggested_category: str = None
+    created_mono: float = field(default_factory=time.monotonic)
+
+def purge_stale_user_states():
+    """Drop conversation states abandoned for longer than USER_STATE_TTL, then trim to USER_STATE_MAX"""
+    cutoff = time.monotonic() - USER_STATE_TTL
+    for user_id, user_state in list(user_states.items()):
+        if user_state.created_mono < cutoff:
+            user_states.pop(user_id, None)
+    for user_id in list(user_states)[:len(user_states) - USER_STATE_MAX]:
+        user_states.pop(user_id, None)
+
 # Enhanced Edit Session Management
+# Session ids only need to be unique per process; seeding with the clock keeps them
+# from repeating across restarts
+session_counter = itertools.count(int(time.time()))
+
 class EditSession:
     """Manages individual expense editing sessions"""
+    # Sessions are short-lived and created on every edit tap; slots make them cheap to allocate
+    __slots__ = ('session_id', 'user_id', 'expense_id', 'expense_data', 'original_data',
+                 'created_at', 'last_activity', 'last_activity_mono', 'changes_made')
+    
     def __init__(self, user_id, expense_id, expense_data):
-        self.session_id = str(uuid.uuid4())[:8]
+        self.session_id = f"{next(session_counter):08x}"
         self.user_id = user_id
         self.expense_id = expense_id
         self.expense_data = expense_data.copy()
         self.original_data = expense_data.copy()
-        self.created_at = datetime.now()
-        self.last_activity = datetime.now()
+        # Wall-clock times are for display; expiry uses the monotonic clock
+        self.created_at = self.last_activity = datetime.now()
+        self.last_activity_mono = time.monotonic()
         self.changes_made = []
         
     def update_field(self, field, new_value, reason="User edit"):
@@ -68,6 +232,7 @@ class EditSession:
         old_value = self.expense_data.get(field)
         self.expense_data[field] = new_value
         self.last_activity = datetime.now()
+        self.last_activity_mono = time.monotonic()
         
         change_record = {
             'field': field,
@@ -80,7 +245,7 @@ class EditSession:
         
     def is_expired(self, timeout_minutes=30):
         """Check if session has expired"""
-        return datetime.now() - self.last_activity > timedelta(minutes=timeout_minutes)
+        return time.monotonic() - self.last_activity_mono > timeout_minutes * 60
         
     def get_summary(self):
         """Get summary of changes made"""
@@ -97,42 +262,53 @@ class EditSessionManager:
     def __init__(self):
         self.sessions = {}
         self.user_sessions = {}  # user_id -> session_id mapping
+        # Re-entrant: create_session cleans up through cleanup_session
+        self._lock = threading.RLock()
+        # Age buckets of session_id -> monotonic creation time, oldest first;
+        # sessions move to the next bucket lazily when stats are read
+        self._age_buckets = (OrderedDict(), OrderedDict(), OrderedDict())
         
     def create_session(self, user_id, expense_id, expense_data):
         """Create new edit session"""
-        # Clean up any existing session for this user
-        self.cleanup_user_sessions(user_id)
-        
-        session = EditSession(user_id, expense_id, expense_data)
-        self.sessions[session.session_id] = session
-        self.user_sessions[user_id] = session.session_id
+        with self._lock:
+            # Clean up any existing session for this user
+            self.cleanup_user_sessions(user_id)
+            
+            session = EditSession(user_id, expense_id, expense_data)
+            self.sessions[session.session_id] = session
+            self.user_sessions[user_id] = session.session_id
+            self._age_buckets[0][session.session_id] = time.monotonic()
         
         logger.info(f"✅ Created edit session {session.session_id} for user {user_id}")
         return session
         
     def get_session(self, user_id):
         """Get active session for user"""
-        session_id = self.user_sessions.get(user_id)
-        if session_id and session_id in self.sessions:
-            session = self.sessions[session_id]
-            if not session.is_expired():
-                return session
-            else:
-                # Session expired, clean up
-                self.cleanup_session(session_id)
+        with self._lock:
+            session_id = self.user_sessions.get(user_id)
+            if session_id and session_id in self.sessions:
+                session = self.sessions[session_id]
+                if not session.is_expired():
+                    return session
+                else:
+                    # Session expired, clean up
+                    self.cleanup_session(session_id)
         return None
         
     def cleanup_session(self, session_id):
         """Clean up specific session"""
-        if session_id in self.sessions:
-            session = self.sessions[session_id]
+        with self._lock:
+            session = self.sessions.pop(session_id, None)
+            if session is None:
+                return
             user_id = session.user_id
-            
-            del self.sessions[session_id]
-            if user_id in self.user_sessions and self.user_sessions[user_id] == session_id:
+            if self.user_sessions.get(user_id) == session_id:
                 del self.user_sessions[user_id]
+            for bucket in self._age_buckets:
+                if bucket.pop(session_id, None) is not None:
+                    break
                 
-            logger.info(f"🧹 Cleaned up session {session_id} for user {user_id}")
+        logger.info(f"🧹 Cleaned up session {session_id} for user {user_id}")
             
     def cleanup_user_sessions(self, user_id):
         """Clean up all sessions for a user"""
@@ -142,75 +318,309 @@ class EditSessionManager:
             
     def cleanup_expired_sessions(self):
         """Clean up all expired sessions"""
-        expired_sessions = []
-        for session_id, session in self.sessions.items():
-            if session.is_expired():
-                expired_sessions.append(session_id)
-                
-        for session_id in expired_sessions:
-            self.cleanup_session(session_id)
+        with self._lock:
+            # Iterate a snapshot; cleanup_session mutates self.sessions
+            expired_sessions = [
+                session_id for session_id, session in list(self.sessions.items())
+                if session.is_expired()
+            ]
+            for session_id in expired_sessions:
+                self.cleanup_session(session_id)
             
         if expired_sessions:
             logger.info(f"🧹 Cleaned up {len(expired_sessions)} expired sessions")
             
     def get_session_stats(self):
         """Get statistics about active sessions"""
-        total_sessions = len(self.sessions)
-        active_users = len(self.user_sessions)
-        
-        return {
-            'total_sessions': total_sessions,
-            'active_users': active_users,
-            'sessions_by_age': {
-                'under_5min': len([s for s in self.sessions.values() if (datetime.now() - s.created_at).seconds < 300]),
-                'under_30min': len([s for s in self.sessions.values() if (datetime.now() - s.created_at).seconds < 1800]),
-                'over_30min': len([s for s in self.sessions.values() if (datetime.now() - s.created_at).seconds >= 1800])
+        with self._lock:
+            young, middle, old = self._age_buckets
+            now = time.monotonic()
+            # Only sessions that crossed a boundary since the last call are touched
+            for source, target, max_age in ((young, middle, 300), (middle, old, 1800)):
+                while source:
+                    session_id, created = next(iter(source.items()))
+                    if now - created < max_age:
+                        break
+                    source.popitem(last=False)
+                    target[session_id] = created
+            
+            return {
+                'total_sessions': len(self.sessions),
+                'active_users': len(self.user_sessions),
+                'sessions_by_age': {
+                    'under_5min': len(young),
+                    'under_30min': len(young) + len(middle),
+                    'over_30min': len(old)
+                }
             }
-        }
 
 # Global edit session manager
 edit_session_manager = EditSessionManager()
 
-# Enhanced default categories
+# Enhanced default categories; a read-only template shared by users who never customized
 DEFAULT_CATEGORIES = {
     'food': {
-        'keywords': ['zomato', 'swiggy', 'restaurant', 'food', 'lunch', 'dinner', 'breakfast', 'cafe', 'pizza', 'burger', 'meal', 'dining', 'eat', 'kitchen'],
+        'keywords': ('zomato', 'swiggy', 'restaurant', 'food', 'lunch', 'dinner', 'breakfast', 'cafe', 'pizza', 'burger', 'meal', 'dining', 'eat', 'kitchen'),
         'emoji': '🍽️'
     },
     'transport': {
-        'keywords': ['uber', 'ola', 'petrol', 'taxi', 'metro', 'bus', 'train', 'auto', 'rickshaw', 'fuel', 'parking', 'toll', 'travel', 'commute'],
+        'keywords': ('uber', 'ola', 'petrol', 'taxi', 'metro', 'bus', 'train', 'auto', 'rickshaw', 'fuel', 'parking', 'toll', 'travel', 'commute'),
         'emoji': '🚗'
     },
     'shopping': {
-        'keywords': ['amazon', 'flipkart', 'shopping', 'mall', 'clothes', 'shoes', 'electronics', 'mobile', 'laptop', 'gadget', 'purchase'],
+        'keywords': ('amazon', 'flipkart', 'shopping', 'mall', 'clothes', 'shoes', 'electronics', 'mobile', 'laptop', 'gadget', 'purchase'),
         'emoji': '🛒'
     },
     'groceries': {
-        'keywords': ['grocery', 'vegetables', 'milk', 'fruits', 'supermarket', 'reliance', 'dmart', 'big bazaar', 'fresh', 'organic'],
+        'keywords': ('grocery', 'vegetables', 'milk', 'fruits', 'supermarket', 'reliance', 'dmart', 'big bazaar', 'fresh', 'organic'),
         'emoji': '🥕'
     },
     'medical': {
-        'keywords': ['hospital', 'doctor', 'medicine', 'pharmacy', 'medical', 'health', 'clinic', 'checkup', 'treatment', 'tablets'],
+        'keywords': ('hospital', 'doctor', 'medicine', 'pharmacy', 'medical', 'health', 'clinic', 'checkup', 'treatment', 'tablets'),
         'emoji': '💊'
     },
     'entertainment': {
-        'keywords': ['movie', 'cinema', 'game', 'music', 'netflix', 'amazon prime', 'hotstar', 'spotify', 'concert', 'show'],
+        'keywords': ('movie', 'cinema', 'game', 'music', 'netflix', 'amazon prime', 'hotstar', 'spotify', 'concert', 'show'),
         'emoji': '🎬'
     },
     'utilities': {
-        'keywords': ['electricity', 'water', 'gas', 'internet', 'mobile', 'wifi', 'broadband', 'recharge', 'bill', 'phone'],
+        'keywords': ('electricity', 'water', 'gas', 'internet', 'mobile', 'wifi', 'broadband', 'recharge', 'bill', 'phone'),
         'emoji': '⚡'
     },
     'education': {
-        'keywords': ['course', 'book', 'education', 'training', 'certification', 'udemy', 'coursera', 'study', 'learning'],
+        'keywords': ('course', 'book', 'education', 'training', 'certification', 'udemy', 'coursera', 'study', 'learning'),
         'emoji': '📚'
     },
     'miscellaneous': {
-        'keywords': [],
+        'keywords': (),
         'emoji': '📝'
     }
 }
 
+def loads_json(data):
+    """Parse JSON with orjson when available, else the stdlib"""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps_json(obj, indent=False):
+    """Serialize JSON to str with orjson when available, else the stdlib"""
+    if orjson:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option).decode('utf-8')
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False)
+
+def dumps_json_bytes(obj, indent=False):
+    """Serialize JSON straight to UTF-8 bytes for writing, skipping orjson's str round trip"""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0))
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False).encode('utf-8')
+
+def parse_llm_json(response):
+    """Parse the JSON payload of a Gemini reply, unwrapping a markdown code fence"""
+    result = response.text
+    # The first fenced block anywhere in the reply wins; partition finds it without regex or split lists
+    _, fence, rest = result.partition('```')
+    if fence:
+        result, _, _ = rest.partition('```')
+        result = result.removeprefix('json')
+    return loads_json(result.strip())
+
+class StateStore(MutableMapping):
+    """Dict-like store persisted to SQLite (WAL) so state survives restarts.
+    Values are JSON, entries expire after ttl seconds (at most maxsize are kept), and reads are served from memory."""
+    def __init__(self, path, table, ttl, maxsize=None):
+        self.table = table
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(f'CREATE TABLE IF NOT EXISTS {table} '
+                           '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)')
+        self._conn.execute(f'DELETE FROM {table} WHERE expires_at < ?', (time.time(),))
+        self._conn.commit()
+        # Kept in expiry order so the first key is always the next to expire
+        self._cache = {
+            key: (loads_json(value), expires_at)
+            for key, value, expires_at in self._conn.execute(
+                f'SELECT key, value, expires_at FROM {table} ORDER BY expires_at')
+        }
+        
+    def __getitem__(self, key):
+        value, expires_at = self._cache[key]
+        if expires_at < time.time():
+            try:
+                del self[key]
+            except KeyError:
+                pass
+            raise KeyError(key)
+        return value
+        
+    def __setitem__(self, key, value):
+        if self.maxsize and key not in self._cache and len(self._cache) >= self.maxsize:
+            self.purge_expired()
+            while len(self._cache) >= self.maxsize:
+                self.pop(next(iter(self._cache)), None)
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            # Re-inserted so a refreshed key moves to the back of the expiry order
+            self._cache.pop(key, None)
+            self._cache[key] = (value, expires_at)
+            with self._conn:
+                self._conn.execute(f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)',
+                                   (key, dumps_json(value), expires_at))
+        
+    def __delitem__(self, key):
+        with self._lock:
+            del self._cache[key]
+            with self._conn:
+                self._conn.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+        
+    def __iter__(self):
+        return iter(list(self._cache))
+        
+    def __len__(self):
+        return len(self._cache)
+        
+    def purge_expired(self):
+        """Drop every expired entry, not just the ones that get read"""
+        now = time.time()
+        for key, (_, expires_at) in list(self._cache.items()):
+            if expires_at < now:
+                self.pop(key, None)
+
+pending_expenses = StateStore(STATE_DB_FILE, 'pending_expenses', PENDING_EXPENSE_TTL, PENDING_EXPENSE_MAX)
+
+def normalize_message(text):
+    """Lowercase and collapse whitespace so trivially different messages share a cache key"""
+    return ' '.join(str(text).lower().split())
+
+def ai_cache_get(key):
+    """Return a cached Gemini result and mark it recently used"""
+    if key not in ai_cache:
+        return None
+    ai_cache.move_to_end(key)
+    value = ai_cache[key]
+    # Callers mutate parsed dicts, so hand out a copy
+    return dict(value) if isinstance(value, dict) else value
+
+def ai_cache_put(key, value):
+    """Store a Gemini result, evicting the least recently used entry when full"""
+    ai_cache[key] = dict(value) if isinstance(value, dict) else value
+    ai_cache.move_to_end(key)
+    if len(ai_cache) > AI_CACHE_SIZE:
+        ai_cache.popitem(last=False)
+
+def is_confident(data):
+    """Check a Gemini result's self-reported confidence against the cache threshold"""
+    try:
+        return float(data.get('confidence', 0)) >= AI_CACHE_MIN_CONFIDENCE
+    except (TypeError, ValueError):
+        return False
+
+@functools.lru_cache(maxsize=256)
+def build_category_matcher(keyword_items):
+    """Compile (keyword, category) pairs into one regex plus a keyword -> category index"""
+    keyword_to_cat = {}
+    for keyword, cat in keyword_items:
+        keyword_to_cat.setdefault(keyword, cat)
+    if not keyword_to_cat:
+        return None, keyword_to_cat
+    # Longest first so "amazon prime" wins over "amazon"; whole words only so "eat" skips "great"
+    keywords = sorted(keyword_to_cat, key=len, reverse=True)
+    return re.compile(r'\b(?:' + '|'.join(re.escape(k) for k in keywords) + r')\b'), keyword_to_cat
+
+def local_categorize(text, categories):
+    """Pick a category from the user's own keywords in one regex pass, without Gemini"""
+    keyword_items = tuple(
+        (keyword.lower(), cat)
+        for cat, cat_data in categories.items()
+        for keyword in cat_data.get('keywords', [])
+        if keyword
+    )
+    matcher, keyword_to_cat = build_category_matcher(keyword_items)
+    if not matcher:
+        return None
+    votes = Counter(keyword_to_cat[keyword] for keyword in matcher.findall(text.lower()))
+    return votes.most_common(1)[0][0] if votes else None
+
+# A number, optionally comma-grouped in Indian (1,20,000) or western (120,000) style
+AMOUNT_NUMBER = r'\d{1,3}(?:,\d{2,3})+(?:\.\d+)?(?!\d)|\d+(?:\.\d+)?'
+# Fast-path patterns for plain expenses like "₹250 uber", "₹1,500 grocery" or "paid 80 at zomato"
+AMOUNT_RE = re.compile(rf'(?:₹|\brs\.?|\brupees?|\bpaid|\bspent)\s*({AMOUNT_NUMBER})|\b({AMOUNT_NUMBER})\s*(?:₹|rs\b|rupees?\b)', re.IGNORECASE)
+PAYMENT_RE = re.compile(r'\b(?:(paytm|gpay|phonepe|upi)|(card|credit|debit))\b')
+# Run on the original text so names like "McDonald's" keep their casing and apostrophe. The name runs
+# over words until an amount, a payment or linking word, or the end ("at big bazaar via upi" -> "big bazaar")
+MERCHANT_STOP_WORDS = r'via|using|with|by|through|for|on|and|paytm|gpay|phonepe|upi|card|credit|debit|cash|rs|rupees?|today'
+MERCHANT_RE = re.compile(
+    rf"(?:\bat|\bfrom|\b(?:paid|sent) to)\s+((?:(?!(?:{MERCHANT_STOP_WORDS})\b)[a-z][a-z0-9&.'’\-]*\s*)+)",
+    re.IGNORECASE)
+# Dates other than today, and money coming in, are left to Gemini
+NOT_LOCAL_RE = re.compile(
+    r'\b(?:yesterday|tomorrow|ago|last|(?:mon|tues|wednes|thurs|fri|satur|sun)day'
+    r'|jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?|sep(?:t|tember)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?'
+    r'|refund(?:ed)?|received|credited|cashback|reversal|returned|got back)\b', re.IGNORECASE)
+# First number in a free-form reply, used when the user types a corrected amount
+NUMBER_RE = re.compile(AMOUNT_NUMBER)
+
+def parse_number(text):
+    """Convert a matched amount to float, dropping digit-grouping commas"""
+    return float(text.replace(',', ''))
+
+def merchant_name(name):
+    """Capitalize a merchant typed in lowercase, keeping any casing the user gave"""
+    name = ' '.join(name.split()).rstrip('.')
+    return ' '.join(word[0].upper() + word[1:] for word in name.split()) if name.islower() else name
+# Short messages with an explicit amount go straight to expense parsing, skipping intent analysis
+EXPENSE_HINT_MAX_LEN = 120
+
+def parse_expense_locally(text, categories):
+    """Build an expense from an explicit amount plus a keyword category, without Gemini"""
+    # Several numbers (split bills, dates, quantities), other dates and refunds need Gemini
+    if len(NUMBER_RE.findall(text)) != 1 or NOT_LOCAL_RE.search(text):
+        return None
+    amount_match = AMOUNT_RE.search(text)
+    category = local_categorize(text, categories)
+    if not amount_match or not category:
+        return None
+    amount = parse_number(amount_match.group(1) or amount_match.group(2))
+    if amount <= 0:
+        return None
+    
+    text_lower = text.lower()
+    payment_match = PAYMENT_RE.search(text_lower)
+    merchant_match = MERCHANT_RE.search(text)
+    return {
+        'amount': int(amount) if amount.is_integer() else amount,
+        'category': category,
+        'description': text.strip()[:100],
+        'merchant': merchant_name(merchant_match.group(1)) if merchant_match else 'Unknown',
+        'payment_method': ('upi' if payment_match.group(1) else 'card') if payment_match else 'cash',
+        'date': datetime.now().strftime('%Y-%m-%d'),
+        'confidence': 0.9,
+        'extraction_notes': 'Amount and category keywords matched locally'
+    }
+
+# (intent, pattern) checked in order on short messages before asking Gemini
+QUICK_INTENTS = tuple((intent, re.compile(pattern, re.IGNORECASE)) for intent, pattern in (
+    ("greeting", r'^\s*(?:hi|hello|hey|hii+|namaste|good (?:morning|afternoon|evening))\b[\s!.]*$'),
+    ("help", r'^\s*(?:help|how does this work|what can you do)\b'),
+    ("sheet_request", r'\b(?:sheet|spreadsheet)\b'),
+    ("summary", r'\b(?:summary|this month|monthly|total spent|how much did i spend)\b'),
+    ("category_management", r'\bcategor(?:y|ies)\b'),
+))
+QUICK_INTENT_MAX_LEN = 60
+
+def quick_intent(text):
+    """Recognise the common non-expense intents with keyword patterns, or None to defer to Gemini"""
+    if len(text) > QUICK_INTENT_MAX_LEN:
+        return None
+    for intent, pattern in QUICK_INTENTS:
+        if pattern.search(text):
+            return intent
+    return None
+
 class GeminiDecisionEngine:
     """AI-powered decision engine for all bot interactions"""
     
@@ -218,6 +628,13 @@ class GeminiDecisionEngine:
     async def analyze_user_intent(message_text, user_context=None):
         """Let Gemini decide what the user wants to do"""
         try:
+            # Amounts don't change the intent, so "₹100 uber" and "₹250 uber" share an entry
+            cache_key = ('intent', re.sub(r'\d+', '#', normalize_message(message_text)),
+                         json.dumps(user_context, sort_keys=True, default=str))
+            cached = ai_cache_get(cache_key)
+            if cached:
+                return cached
+            
             context_info = ""
             if user_context:
                 context_info = f"User context: {json.dumps(user_context, indent=2)}"
@@ -250,16 +667,11 @@ Intent definitions:
 - unclear: Message is ambiguous
 """
             
-            response = model.generate_content(prompt)
-            result = response.text.strip()
-            
-            # Clean up response
-            if '```json' in result:
-                result = result.split('```json')[1].split('```')[0].strip()
-            elif '```' in result:
-                result = result.split('```')[1].split('```')[0].strip()
-            
-            return json.loads(result)
+            response = await gemini_generate(prompt)
+            intent_data = parse_llm_json(response)
+            if is_confident(intent_data):
+                ai_cache_put(cache_key, intent_data)
+            return intent_data
         except Exception as e:
             logger.error(f"Intent analysis error: {e}")
             return {
@@ -275,6 +687,13 @@ Intent definitions:
     async def generate_smart_response(message_text, intent_data, user_context=None):
         """Generate contextual response using Gemini"""
         try:
+            cache_key = ('response', normalize_message(message_text),
+                         json.dumps(intent_data, sort_keys=True, default=str),
+                         json.dumps(user_context, sort_keys=True, default=str))
+            cached = ai_cache_get(cache_key)
+            if cached:
+                return cached
+            
             context_info = ""
             if user_context:
                 context_info = f"User context: {json.dumps(user_context, indent=2)}"
@@ -299,8 +718,10 @@ If they're greeting, be warm and welcoming.
 Response should be 2-4 sentences maximum unless more detail is needed.
 """
             
-            response = model.generate_content(prompt)
-            return response.text.strip()
+            response = await gemini_generate(prompt)
+            reply = response.text.strip()
+            ai_cache_put(cache_key, reply)
+            return reply
         except Exception as e:
             logger.error(f"Response generation error: {e}")
             return "I'm having trouble understanding. Could you please rephrase or try again? 🤔"
@@ -310,6 +731,13 @@ Response should be 2-4 sentences maximum unless more detail is needed.
         """Enhanced expense parsing with better AI understanding"""
         try:
             category_list = list(categories.keys())
+            today = datetime.now().strftime('%Y-%m-%d')
+            
+            # The prompt embeds today's date, so it is part of the key
+            cache_key = ('expense', normalize_message(text), tuple(sorted(category_list)), today)
+            cached = ai_cache_get(cache_key)
+            if cached:
+                return cached
             
             prompt = f"""
 Parse this expense text: "{text}"
@@ -323,7 +751,7 @@ Extract expense information and return ONLY valid JSON:
     "description": "brief description",
     "merchant": "merchant/vendor name",
     "payment_method": "upi|cash|card|online",
-    "date": "{datetime.now().strftime('%Y-%m-%d')}",
+    "date": "{today}",
     "confidence": 0.95,
     "extraction_notes": "what was extracted and why"
 }}
@@ -336,34 +764,39 @@ Rules:
 - Be smart about inferring context
 """
             
-            response = model.generate_content(prompt)
-            result = response.text.strip()
-            
-            # Clean response
-            if '```json' in result:
-                result = result.split('```json')[1].split('```')[0].strip()
-            elif '```' in result:
-                result = result.split('```')[1].split('```')[0].strip()
-            
-            parsed_data = json.loads(result)
+            response = await gemini_generate(prompt)
+            parsed_data = parse_llm_json(response)
             
             # Validate required fields
             if not parsed_data.get('amount') or parsed_data['amount'] <= 0:
                 return None
-                
+            
+            if is_confident(parsed_data):
+                ai_cache_put(cache_key, parsed_data)
             return parsed_data
         except Exception as e:
             logger.error(f"AI expense parsing error: {e}")
             return None
 
     @staticmethod
-    async def process_image_with_ai(image_bytes):
+    async def process_image_with_ai(image_file):
         """Process UPI screenshots with enhanced AI understanding"""
         try:
-            image = Image.open(BytesIO(image_bytes))
-            
+            image_file.seek(0)
+            image = Image.open(image_file)
+            
+            # Fewer pixels and bytes to upload; Gemini latency and cost scale with both
+            image.thumbnail((OCR_MAX_SIZE, OCR_MAX_SIZE), Image.LANCZOS)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            buffer = BytesIO()
+            image.save(buffer, 'JPEG', quality=OCR_JPEG_QUALITY, optimize=True)
+            buffer.seek(0)
+            image = Image.open(buffer)
+            
+            # One multimodal call reads the image and returns the structured record
             prompt = """
-Analyze this payment/transaction image and extract ALL payment details.
+Analyze this payment/transaction image and extract the payment details.
 
 Look for:
 - Transaction amount (₹, Rs, rupees)
@@ -373,55 +806,51 @@ Look for:
 - Date/time
 - Any other transaction details
 
-Provide detailed extraction of all visible text and numbers.
-Be very thorough and include everything you can see.
-"""
-            
-            response = model.generate_content([prompt, image])
-            extracted_text = response.text.strip()
-            
-            # Now parse the extracted text for structured data
-            parse_prompt = f"""
-From this extracted text: "{extracted_text}"
-
-Create a structured expense record as JSON:
-{{
+Return ONLY a JSON object in this format:
+{
     "amount": number,
     "merchant": "merchant name",
     "payment_method": "upi|card|wallet",
     "transaction_id": "if available",
-    "raw_text": "original extracted text",
+    "raw_text": "all visible text and numbers from the image",
     "confidence": 0.95
-}}
-
-Extract the most relevant transaction information.
+}
 """
             
-            parse_response = model.generate_content(parse_prompt)
-            result = parse_response.text.strip()
-            
-            if '```json' in result:
-                result = result.split('```json')[1].split('```')[0].strip()
-            elif '```' in result:
-                result = result.split('```')[1].split('```')[0].strip()
+            response = await gemini_generate([prompt, image])
+            parsed_data = parse_llm_json(response)
             
             return {
-                'extracted_text': extracted_text,
-                'parsed_data': json.loads(result)
+                'extracted_text': str(parsed_data.get('raw_text') or ''),
+                'parsed_data': parsed_data
             }
         except Exception as e:
             logger.error(f"Image processing error: {e}")
             return None
 
 # Utility functions with enhanced error handling
+def read_data_file(json_path):
+    """Load a data file, migrating legacy JSON to msgpack on the next save; None if missing"""
+    path = data_file_path(json_path)
+    if path != json_path and os.path.exists(path):
+        with open(path, 'rb') as f:
+            return msgpack.unpackb(f.read(), raw=False)
+    if os.path.exists(json_path):
+        with open(json_path, 'r', encoding='utf-8') as f:
+            data = loads_json(f.read())
+        if path != json_path:
+            dirty_files.add(json_path)
+        return data
+    return None
+
 def load_users():
     """Load user data with error recovery"""
     global user_sheets
     try:
-        if os.path.exists(USERS_FILE):
-            with open(USERS_FILE, 'r', encoding='utf-8') as f:
-                user_sheets = json.load(f)
-                logger.info(f"✅ Loaded {len(user_sheets)} users")
+        data = read_data_file(USERS_FILE)
+        if data is not None:
+            user_sheets = data
+            logger.info(f"✅ Loaded {len(user_sheets)} users")
         else:
             user_sheets = {}
             logger.info("📝 Created new users file")
@@ -430,27 +859,17 @@ def load_users():
         user_sheets = {}
 
 def save_users():
-    """Save user data with backup"""
-    try:
-        # Create backup
-        if os.path.exists(USERS_FILE):
-            backup_file = f"{USERS_FILE}.backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-            os.rename(USERS_FILE, backup_file)
-        
-        with open(USERS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(user_sheets, f, indent=2, ensure_ascii=False)
-        logger.info("✅ Users saved successfully")
-    except Exception as e:
-        logger.error(f"❌ Error saving users: {e}")
+    """Mark user data for the next debounced save"""
+    dirty_files.add(USERS_FILE)
 
 def load_categories():
     """Load categories with error recovery"""
     global user_categories
     try:
-        if os.path.exists(CATEGORIES_FILE):
-            with open(CATEGORIES_FILE, 'r', encoding='utf-8') as f:
-                user_categories = json.load(f)
-                logger.info(f"✅ Loaded categories for {len(user_categories)} users")
+        data = read_data_file(CATEGORIES_FILE)
+        if data is not None:
+            user_categories = data
+            logger.info(f"✅ Loaded categories for {len(user_categories)} users")
         else:
             user_categories = {}
             logger.info("📝 Created new categories file")
@@ -458,75 +877,170 @@ def load_categories():
         logger.error(f"❌ Error loading categories: {e}")
         user_categories = {}
 
-def save_categories():
-    """Save categories with backup"""
+def load_aggregates():
+    """Load running spend totals with error recovery"""
+    global user_aggregates
     try:
-        if os.path.exists(CATEGORIES_FILE):
-            backup_file = f"{CATEGORIES_FILE}.backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-            os.rename(CATEGORIES_FILE, backup_file)
-        
-        with open(CATEGORIES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(user_categories, f, indent=2, ensure_ascii=False)
-        logger.info("✅ Categories saved successfully")
+        data = read_data_file(AGGREGATES_FILE)
+        user_aggregates = data if data is not None else {}
+        logger.info(f"✅ Loaded spend totals for {len(user_aggregates)} users")
     except Exception as e:
-        logger.error(f"❌ Error saving categories: {e}")
+        logger.error(f"❌ Error loading spend totals: {e}")
+        user_aggregates = {}
+
+def save_categories():
+    """Mark categories for the next debounced save"""
+    dirty_files.add(CATEGORIES_FILE)
+
+def write_data_atomic(json_path, data):
+    """Write a data file to a temp file and swap it in, rotating a few backups of the old file"""
+    path = data_file_path(json_path)
+    if msgpack:
+        payload = msgpack.packb(data, use_bin_type=True)
+    else:
+        payload = dumps_json_bytes(data, indent=True)
+    
+    # Per-process temp name so two bot instances never write the same temp file
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    
+    if os.path.exists(path):
+        for i in range(BACKUP_COUNT - 1, 0, -1):
+            if os.path.exists(f"{path}.bak.{i - 1}"):
+                os.replace(f"{path}.bak.{i - 1}", f"{path}.bak.{i}")
+        # Hard-link rather than move so the live file never disappears; the swap below
+        # leaves the link pointing at the old contents without copying them
+        if os.path.exists(f"{path}.bak.0"):
+            os.remove(f"{path}.bak.0")
+        try:
+            os.link(path, f"{path}.bak.0")
+        except OSError:
+            shutil.copy2(path, f"{path}.bak.0")
+    os.replace(tmp_file, path)
+    if path != json_path and os.path.exists(json_path):
+        # Migrated: set the legacy JSON aside so it isn't read again if msgpack goes missing
+        os.replace(json_path, f"{json_path}.migrated")
+        logger.info(f"📦 Migrated {json_path} to {path}")
+
+def snapshot_aggregates():
+    """Deep copy of the running totals, taken while the sheet writer can't update them"""
+    with aggregates_lock:
+        return copy.deepcopy(user_aggregates)
+
+def flush_dirty_files():
+    """Write every data file marked dirty since the last flush"""
+    snapshots = (
+        # Snapshot: the sheet writer thread may add users meanwhile
+        (USERS_FILE, lambda: dict(user_sheets)),
+        # Users still on the shared defaults get them back from get_user_categories
+        (CATEGORIES_FILE, lambda: {user_id: categories for user_id, categories in list(user_categories.items())
+                                   if categories is not DEFAULT_CATEGORIES}),
+        (AGGREGATES_FILE, snapshot_aggregates),
+    )
+    for path, snapshot in snapshots:
+        if path not in dirty_files:
+            continue
+        dirty_files.discard(path)
+        try:
+            with save_lock:
+                write_data_atomic(path, snapshot())
+            logger.info(f"✅ Saved {data_file_path(path)}")
+        except Exception as e:
+            logger.error(f"❌ Error saving {path}: {e}")
+            dirty_files.add(path)
 
 def get_user_categories(user_id):
     """Get user categories with initialization"""
     user_id_str = str(user_id)
     if user_id_str not in user_categories:
-        user_categories[user_id_str] = DEFAULT_CATEGORIES.copy()
-        save_categories()
+        # Shared read-only template until the user customizes (see get_editable_categories).
+        # Nothing to persist yet: untouched defaults are rebuilt on demand after a restart
+        user_categories[user_id_str] = DEFAULT_CATEGORIES
         logger.info(f"✅ Initialized categories for user {user_id}")
     return user_categories[user_id_str]
 
+def get_editable_categories(user_id):
+    """Get user categories for modification, copying the shared defaults on first write"""
+    user_id_str = str(user_id)
+    categories = get_user_categories(user_id)
+    if categories is DEFAULT_CATEGORIES:
+        categories = {
+            cat: {'keywords': list(cat_data['keywords']), 'emoji': cat_data['emoji']}
+            for cat, cat_data in DEFAULT_CATEGORIES.items()
+        }
+        user_categories[user_id_str] = categories
+    return categories
+
+@functools.lru_cache(maxsize=1024)
+def category_title(name):
+    """Display form of a category name; the set of names is small, so each is titlecased once"""
+    return name.title()
+
 def get_google_client():
-    """Initialize Google Sheets client with retry logic, supporting environment variable credentials."""
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-            
-            # Check for credentials in environment variable first
-            service_account_json = os.getenv('GOOGLE_SERVICE_ACCOUNT_CREDENTIALS_JSON')
-            if service_account_json:
-                try:
-                    # Handle potential base64 encoding
-                    if not service_account_json.strip().startswith('{'):
-                        # Assume it's base64 encoded
-                        import base64
-                        service_account_json = base64.b64decode(service_account_json).decode('utf-8')
-                        logger.info("🔓 Decoded base64 credentials")
+    """Get the shared Google Sheets client, authorizing with retry logic on first use."""
+    global google_client
+    if google_client:
+        return google_client
+    with google_client_lock:
+        if google_client:
+            return google_client
+        max_retries = 3
+        for attempt in range(max_retries):
+            try:
+                scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+            
+                # Check for credentials in environment variable first
+                service_account_json = os.getenv('GOOGLE_SERVICE_ACCOUNT_CREDENTIALS_JSON')
+                if service_account_json:
+                    try:
+                        # Handle potential base64 encoding
+                        if not service_account_json.strip().startswith('{'):
+                            # Assume it's base64 encoded
+                            import base64
+                            service_account_json = base64.b64decode(service_account_json).decode('utf-8')
+                            logger.info("🔓 Decoded base64 credentials")
                     
-                    # Parse JSON directly from environment variable
-                    creds_dict = json.loads(service_account_json)
-                    creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
-                    logger.info("✅ Google Sheets client initialized from environment variable")
-                except json.JSONDecodeError as je:
-                    logger.error(f"❌ JSON parsing error: {je}")
-                    logger.error(f"📝 Credential string preview: {service_account_json[:100]}...")
-                    raise
-                except Exception as pe:
-                    logger.error(f"❌ Credential processing error: {pe}")
-                    raise
-            else:
-                # Fallback to local file for local development if env var not set
-                # IMPORTANT: Ensure this file is NOT committed to GitHub!
-                local_service_account_path = 'C:\\telegram4.0\\telegram_service_account.json'
-                if os.path.exists(local_service_account_path):
-                    creds = Credentials.from_service_account_file(local_service_account_path, scopes=scope)
-                    logger.info("✅ Google Sheets client initialized from local file")
+                        # Parse JSON directly from environment variable
+                        creds_dict = json.loads(service_account_json)
+                        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
+                        logger.info("✅ Google Sheets client initialized from environment variable")
+                    except json.JSONDecodeError as je:
+                        logger.error(f"❌ JSON parsing error: {je}")
+                        logger.error(f"📝 Credential string preview: {service_account_json[:100]}...")
+                        raise
+                    except Exception as pe:
+                        logger.error(f"❌ Credential processing error: {pe}")
+                        raise
                 else:
-                    raise FileNotFoundError(f"Google Service Account JSON not found at {local_service_account_path} and GOOGLE_SERVICE_ACCOUNT_CREDENTIALS_JSON env var is not set.")
+                    # Fallback to local file for local development if env var not set
+                    # IMPORTANT: Ensure this file is NOT committed to GitHub!
+                    local_service_account_path = 'C:\\telegram4.0\\telegram_service_account.json'
+                    if os.path.exists(local_service_account_path):
+                        creds = Credentials.from_service_account_file(local_service_account_path, scopes=scope)
+                        logger.info("✅ Google Sheets client initialized from local file")
+                    else:
+                        raise FileNotFoundError(f"Google Service Account JSON not found at {local_service_account_path} and GOOGLE_SERVICE_ACCOUNT_CREDENTIALS_JSON env var is not set.")
             
-            client = gspread.authorize(creds)
-            return client
-        except Exception as e:
-            logger.error(f"❌ Google client error (attempt {attempt + 1}): {e}")
-            if attempt < max_retries - 1:
-                import time
-                time.sleep(2 ** attempt)  # Exponential backoff
-    return None
+                google_client = gspread.authorize(creds)
+                return google_client
+            except Exception as e:
+                logger.error(f"❌ Google client error (attempt {attempt + 1}): {e}")
+                if attempt < max_retries - 1:
+                    time.sleep(2 ** attempt)  # Exponential backoff
+        return None
+
+def drop_cached_sheet(user_id, error=None):
+    """Forget a cached worksheet after an API error (and the client on 401)"""
+    global google_client
+    if isinstance(error, gspread.exceptions.APIError):
+        status = error.response.status_code
+        if status in (401, 404):
+            sheet_cache.pop(str(user_id), None)
+        if status == 401:
+            google_client = None
 
 # Enhanced Google Sheets access with proper user permissions
 def get_user_sheet(user_id):
@@ -534,11 +1048,16 @@ def get_user_sheet(user_id):
     try:
         user_id_str = str(user_id)
         
+        cached = sheet_cache.get(user_id_str)
+        if cached and time.monotonic() - cached[0] < SHEET_CACHE_TTL:
+            return cached[1]
+        
         # Try to open existing sheet
         if user_id_str in user_sheets:
             try:
                 gc = get_google_client()
                 sheet = gc.open_by_key(user_sheets[user_id_str]).sheet1
+                sheet_cache[user_id_str] = (time.monotonic(), sheet)
                 logger.info(f"✅ Opened existing sheet for user {user_id}")
                 return sheet
             except Exception as e:
@@ -550,15 +1069,22 @@ def get_user_sheet(user_id):
         spreadsheet = gc.create(sheet_name)
         sheet = spreadsheet.sheet1
         
-        # Set up headers
+        # Write and format headers in a single batchUpdate request
         headers = ['Date', 'Amount', 'Merchant', 'Category', 'Description', 'Payment Method', 'Status', 'Confidence', 'AI Notes']
-        sheet.append_row(headers)
-        
-        # Format headers
-        sheet.format('A1:I1', {
+        header_format = {
             'backgroundColor': {'red': 0.2, 'green': 0.6, 'blue': 0.9},
             'textFormat': {'bold': True, 'foregroundColor': {'red': 1, 'green': 1, 'blue': 1}}
-        })
+        }
+        spreadsheet.batch_update({'requests': [{
+            'updateCells': {
+                'start': {'sheetId': sheet.id, 'rowIndex': 0, 'columnIndex': 0},
+                'rows': [{'values': [
+                    {'userEnteredValue': {'stringValue': header}, 'userEnteredFormat': header_format}
+                    for header in headers
+                ]}],
+                'fields': 'userEnteredValue,userEnteredFormat(backgroundColor,textFormat)'
+            }
+        }]})
         
         # Store sheet ID
         user_sheets[user_id_str] = spreadsheet.id
@@ -585,6 +1111,7 @@ def get_user_sheet(user_id):
             except Exception as e2:
                 logger.error(f"❌ All sharing methods failed: {e2}")
         
+        sheet_cache[user_id_str] = (time.monotonic(), sheet)
         logger.info(f"✅ Created new sheet for user {user_id}: {spreadsheet.id}")
         return sheet
         
@@ -592,6 +1119,105 @@ def get_user_sheet(user_id):
         logger.error(f"❌ Sheet error for user {user_id}: {e}")
         return None
 
+async def run_sheets_call(func, *args):
+    """Run a blocking gspread call on the Sheets worker pool without stalling the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(sheets_executor, functools.partial(func, *args))
+
+# The only columns summaries read, as (header, A1 range) per the header row written in get_user_sheet
+SUMMARY_COLUMNS = (('Date', 'A2:A'), ('Amount', 'B2:B'), ('Category', 'D2:D'), ('Payment Method', 'F2:F'))
+
+def get_cached_records(user_id):
+    """Get a user's expense records (summary columns only), reusing a recent fetch (blocking; run on the Sheets pool)"""
+    cached = records_cache.get(user_id)
+    if cached and time.monotonic() - cached[0] < RECORDS_CACHE_TTL:
+        return cached[1]
+    sheet = get_user_sheet(user_id)
+    if not sheet:
+        return None
+    # One values.batchGet for the needed columns instead of downloading every column. Unformatted,
+    # so amounts arrive as numbers whatever the column's display format ("₹1,500.00" would parse as 0);
+    # dates the sheet converted stay date strings rather than serial numbers
+    columns = sheet.batch_get([cell_range for _, cell_range in SUMMARY_COLUMNS],
+                              value_render_option='UNFORMATTED_VALUE', date_time_render_option='FORMATTED_STRING')
+    records = []
+    for row in itertools.zip_longest(*columns, fillvalue=[]):
+        if not any(row):
+            continue
+        records.append({header: cell[0] if cell else '' for (header, _), cell in zip(SUMMARY_COLUMNS, row)})
+    records_cache[user_id] = (time.monotonic(), records)
+    return records
+
+def parse_amount(value):
+    """Parse a sheet amount, which may be a number, a numeric string or blank"""
+    # Queued rows and numeric cells are already numbers; only strings need float()
+    if type(value) in (int, float):
+        return value
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def add_to_aggregates(aggregates, date, amount, category, payment_method):
+    """Add one expense to a user's monthly and lifetime running totals"""
+    # Every row repeats the same few names; interned keys hash once and compare by identity
+    category = sys.intern(str(category or 'miscellaneous'))
+    payment_method = sys.intern(str(payment_method or 'unknown'))
+    for period in (str(date)[:7], '_all'):
+        totals = aggregates.setdefault(period, {'total': 0.0, 'count': 0, 'category': {}, 'payment_method': {}})
+        totals['total'] += amount
+        totals['count'] += 1
+        totals['category'][category] = totals['category'].get(category, 0) + amount
+        totals['payment_method'][payment_method] = totals['payment_method'].get(payment_method, 0) + amount
+
+def aggregates_are_current(entry, user_id_str):
+    """Whether stored totals were built from the user's current sheet recently enough to trust"""
+    return (isinstance(entry, dict) and 'totals' in entry
+            and entry.get('sheet_id') == user_sheets.get(user_id_str)
+            and time.time() - entry.get('built_at', 0) < AGGREGATES_TTL)
+
+def invalidate_user_aggregates(user_id):
+    """Drop a user's stored totals so the next summary rebuilds them from the sheet"""
+    with aggregates_lock:
+        if user_aggregates.pop(str(user_id), None) is not None:
+            dirty_files.add(AGGREGATES_FILE)
+    records_cache.pop(user_id, None)
+
+def get_user_aggregates(user_id, rebuild=False):
+    """Get a copy of a user's running totals, rebuilt from the sheet when missing, stale or for another sheet (blocking)"""
+    user_id_str = str(user_id)
+    if rebuild:
+        invalidate_user_aggregates(user_id)
+    for _ in range(AGGREGATES_REBUILD_ATTEMPTS):
+        with aggregates_lock:
+            entry = user_aggregates.get(user_id_str)
+            if aggregates_are_current(entry, user_id_str):
+                return copy.deepcopy(entry['totals'])
+            generation = aggregates_generation.get(user_id_str, 0)
+        
+        # Fetch and total outside the lock so the flusher and file saves never wait on Sheets
+        records = get_cached_records(user_id)
+        if records is None:
+            return None
+        aggregates = {}
+        for record in records:
+            add_to_aggregates(aggregates, record.get('Date', ''), parse_amount(record.get('Amount')),
+                              record.get('Category', 'miscellaneous'), record.get('Payment Method', 'unknown'))
+        
+        with aggregates_lock:
+            # Rows appended during the fetch may or may not be in it; keeping these totals could count them twice
+            if aggregates_generation.get(user_id_str, 0) == generation:
+                user_aggregates[user_id_str] = {
+                    # get_cached_records may have just created the sheet, so read the id afterwards
+                    'sheet_id': user_sheets.get(user_id_str),
+                    'built_at': time.time(),
+                    'totals': aggregates
+                }
+                dirty_files.add(AGGREGATES_FILE)
+                return copy.deepcopy(aggregates)
+        records_cache.pop(user_id, None)
+    # Writes kept racing the rebuild: answer from the last fetch and rebuild next time
+    return aggregates
+
 def get_sheet_url(user_id):
     """Get the accessible URL for user's sheet"""
     try:
@@ -612,13 +1238,8 @@ def get_user_email(user_id):
     return None
 
 def add_expense_to_sheet(user_id, expense_data, status="Confirmed"):
-    """Add expense with enhanced data and error handling"""
+    """Queue expense for the next batched sheet write"""
     try:
-        sheet = get_user_sheet(user_id)
-        if not sheet:
-            logger.error(f"❌ No sheet available for user {user_id}")
-            return False
-        
         # Ensure 'description' and 'merchant' keys exist to avoid KeyError
         description = expense_data.get('description', 'No description')
         merchant = expense_data.get('merchant', 'Unknown')
@@ -636,22 +1257,304 @@ def add_expense_to_sheet(user_id, expense_data, status="Confirmed"):
             expense_data.get('extraction_notes', 'Auto-detected') # AI Notes column
         ]
         
-        sheet.append_row(row)
-        logger.info(f"✅ Added expense to sheet for user {user_id}: ₹{expense_data.get('amount')}")
+        with pending_writes_lock:
+            pending_writes.setdefault(user_id, []).append(row)
+            queued = sum(len(rows) for rows in pending_writes.values())
+        if queued >= WRITE_BUFFER_MAX:
+            write_flush_event.set()
+        logger.info(f"✅ Queued expense for user {user_id}: ₹{expense_data.get('amount')}")
         return True
     except Exception as e:
         logger.error(f"❌ Error adding expense for user {user_id}: {e}")
         return False
 
+def is_retryable_write_error(error):
+    """Whether a failed append is worth retrying: client errors other than timeouts and quota are permanent"""
+    if isinstance(error, gspread.exceptions.APIError):
+        status = error.response.status_code
+        return not (400 <= status < 500) or status in (408, 429)
+    return True
+
+def dead_letter_rows(user_id, rows, error):
+    """Give up on a batch of rows, keeping them in DEAD_LETTER_FILE so they can be re-entered by hand"""
+    logger.error(f"🪦 Giving up on {len(rows)} expense(s) for user {user_id} after: {error}")
+    try:
+        with open(DEAD_LETTER_FILE, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'user_id': str(user_id), 'failed_at': datetime.now().isoformat(),
+                                'error': str(error), 'rows': rows}, default=str) + '\n')
+    except OSError as e:
+        logger.error(f"❌ Could not save failed expenses for user {user_id}: {e}")
+
+def flush_pending_writes():
+    """Write all queued rows with a single append_rows call per user"""
+    with pending_writes_lock:
+        batches = dict(pending_writes)
+        pending_writes.clear()
+    for user_id, rows in batches.items():
+        try:
+            sheet = get_user_sheet(user_id)
+            if not sheet:
+                raise RuntimeError("no sheet available")
+            sheet.append_rows(rows, value_input_option='RAW')
+            records_cache.pop(user_id, None)
+            with aggregates_lock:
+                # A rebuild in flight sees the new generation and refetches instead of double counting
+                aggregates_generation[str(user_id)] = aggregates_generation.get(str(user_id), 0) + 1
+                # Users without current totals get these rows when their totals are rebuilt
+                entry = user_aggregates.get(str(user_id))
+                if aggregates_are_current(entry, str(user_id)):
+                    for row in rows:
+                        add_to_aggregates(entry['totals'], row[0], parse_amount(row[1]), row[3], row[5])
+                    dirty_files.add(AGGREGATES_FILE)
+            logger.info(f"✅ Wrote {len(rows)} expense(s) to sheet for user {user_id}")
+        except Exception as e:
+            logger.error(f"❌ Error writing expenses for user {user_id}: {e}")
+            drop_cached_sheet(user_id, e)
+            with pending_writes_lock:
+                attempts = write_attempts.get(user_id, 0) + 1
+                if is_retryable_write_error(e) and attempts < WRITE_MAX_ATTEMPTS:
+                    write_attempts[user_id] = attempts
+                    # Put the rows back in front of anything queued meanwhile
+                    pending_writes[user_id] = rows + pending_writes.get(user_id, [])
+                    continue
+                write_attempts.pop(user_id, None)
+            dead_letter_rows(user_id, rows, e)
+        else:
+            with pending_writes_lock:
+                write_attempts.pop(user_id, None)
+
+async def flush_writes_periodically():
+    """Background task that flushes queued sheet writes and dirty data files"""
+    while True:
+        try:
+            await asyncio.wait_for(write_flush_event.wait(), WRITE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        write_flush_event.clear()
+        await run_sheets_call(flush_pending_writes)
+        # JSON dumps and fsyncs stay off the event loop; snapshots are taken under the GIL or aggregates_lock
+        await asyncio.to_thread(flush_dirty_files)
+
+async def expire_state_periodically():
+    """Background task that reclaims abandoned pending expenses, conversation states and edit sessions"""
+    while True:
+        await asyncio.sleep(STATE_EXPIRY_INTERVAL)
+        try:
+            edit_session_manager.cleanup_expired_sessions()
+            pending_expenses.purge_expired()
+            purge_stale_user_states()
+        except Exception as e:
+            logger.error(f"❌ State expiry error: {e}")
+
+async def start_background_tasks(app):
+    """Start the batched sheet writer and the state expiry sweep once the application is initialized"""
+    app.create_task(flush_writes_periodically())
+    app.create_task(expire_state_periodically())
+    # Authorize the shared Sheets client now so the first expense doesn't pay for it
+    app.create_task(run_sheets_call(get_google_client))
+
+async def stop_write_flusher(app):
+    """Flush whatever is still queued before shutting down"""
+    await run_sheets_call(flush_pending_writes)
+    await asyncio.to_thread(flush_dirty_files)
+
+def flush_on_exit():
+    """Last-chance flush when the process exits without post_shutdown running"""
+    if pending_writes:
+        flush_pending_writes()
+    flush_dirty_files()
+
+# Registered after the log listener so it runs first and can still log
+atexit.register(flush_on_exit)
+
+@dataclass(slots=True)
+class PendingEdit:
+    """Latest text waiting to replace an inline message"""
+    query: object
+    text: str
+    reply_markup: object = None
+    deadline: float = 0.0
+
+class EditCoalescer:
+    """Debounce edit_message_text per message so only the last edit of a quick burst is sent"""
+    def __init__(self):
+        self.pending = {}
+        self._tasks = set()
+        
+    @staticmethod
+    def message_key(query):
+        """Identify the message a callback query edits"""
+        message = query.message
+        return (message.chat_id, message.message_id) if message else query.inline_message_id
+
+    def schedule(self, query, text, reply_markup=None):
+        """Queue an edit of the query's message, replacing any edit still waiting for it"""
+        key = self.message_key(query)
+        loop = asyncio.get_running_loop()
+        delay = EDIT_DEBOUNCE if len(text) <= EDIT_SHORT_TEXT_LEN else EDIT_DEBOUNCE_LONG
+        
+        edit = self.pending.get(key)
+        if edit:
+            edit.query, edit.text, edit.reply_markup = query, text, reply_markup
+            edit.deadline = loop.time() + delay
+            return
+        self.pending[key] = PendingEdit(query, text, reply_markup, loop.time() + delay)
+        task = asyncio.create_task(self._send_when_quiet(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        
+    async def send_now(self, query, text, reply_markup=None):
+        """Send a final edit at once, dropping any debounced edit still waiting for the message"""
+        self.pending.pop(self.message_key(query), None)
+        try:
+            await query.edit_message_text(text, reply_markup=reply_markup)
+        except Exception as e:
+            logger.error(f"❌ Message edit failed: {e}")
+
+    async def _send_when_quiet(self, key):
+        """Wait until the message has had no new edits for its debounce window, then send the last one"""
+        loop = asyncio.get_running_loop()
+        edit = self.pending[key]
+        while (remaining := edit.deadline - loop.time()) > 0:
+            await asyncio.sleep(remaining)
+        if self.pending.get(key) is not edit:
+            return  # dropped by send_now
+        del self.pending[key]
+        try:
+            await edit.query.edit_message_text(edit.text, reply_markup=edit.reply_markup)
+        except Exception as e:
+            logger.error(f"❌ Message edit failed: {e}")
+
+edit_coalescer = EditCoalescer()
+
 # Keyboard creation functions
+# (label, callback prefix) for the per-expense approval buttons
+APPROVAL_BUTTONS = (("✅ Approve", "approve_"), ("✏️ Edit", "edit_"), ("❌ Reject", "reject_"))
+
+# Keyboards that never change are built once and shared
+CANCEL_ADD_CATEGORY_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data="cancel_add_category")]])
+
+MAIN_MENU_KEYBOARD = ReplyKeyboardMarkup([
+    [KeyboardButton("📊 View Sheet"), KeyboardButton("📂 Categories")],
+    [KeyboardButton("📈 Summary"), KeyboardButton("❓ Help")],
+    [KeyboardButton("🤖 Chat with AI")]
+], resize_keyboard=True)
+
+# Replies to a "did you mean" category suggestion; anything else is taken as a new category name
+CATEGORY_SUGGESTION_ACCEPT = frozenset({'yes', 'y'})
+CATEGORY_SUGGESTION_REJECT = frozenset({'no', 'n'})
+
+# Reply-keyboard labels routed to handle_menu_button
+MENU_BUTTONS = frozenset({"📊 View Sheet", "📂 Categories", "📈 Summary", "❓ Help"})
+
+# Approval prompts, filled in with str.format
+EXPENSE_TEMPLATE = """
+💰 **Expense Detected**
+
+**Amount:** ₹{amount}
+**Category:** {category_emoji} {category}
+**Merchant:** {merchant}
+**Payment:** {payment_method}
+**Date:** {date}
+
+**AI Confidence:** {confidence}
+**Notes:** {notes}
+
+Please review and approve:
+"""
+
+# Reply once an approved or edited expense is saved
+SAVED_EXPENSE_TEMPLATE = "✅ **{response}**\n\n💰 ₹{amount} - {merchant}\n📂 {category}"
+
+# Static messages are pre-rendered HTML (sent with ParseMode.HTML); dynamic values must go through html.escape
+SCREENSHOT_TEMPLATE_HTML = """
+📱 <b>From Screenshot:</b>
+
+<b>Amount:</b> ₹{amount}
+<b>Merchant:</b> {merchant}
+<b>Payment:</b> {payment_method}
+<b>Transaction ID:</b> {transaction_id}
+
+Please review and approve:
+"""
+
+DEMO_MESSAGE_HTML = """
+📸 <b>Try This Right Now:</b>
+
+<b>Option 1 - Upload a Screenshot:</b>
+• Take a screenshot of any UPI payment 
+• Send it to me - I'll extract all details automatically!
+
+<b>Option 2 - Type an Expense:</b>
+• Just type: "Lunch ₹350 at McDonald's"
+• Or: "Uber ride ₹150"
+• Or: "Grocery ₹2500"
+
+<b>What I'll do:</b>
+✅ Extract amount, merchant, category
+✅ Save to your personal Google Sheet
+✅ Smart categorization with AI
+✅ Interactive editing if needed
+
+<b>Ready to try?</b> Send me any expense! 🚀
+"""
+
+# Appended to the AI-generated help reply
+HELP_TEXT_HTML = """
+
+📝 <b>Expense Examples:</b>
+• "Lunch ₹350 at McDonald's"
+• "Uber ride ₹150"
+• "Grocery shopping ₹2500 at BigBazaar"
+• Upload UPI/payment screenshots
+
+🎛️ <b>Commands:</b>
+• /start - Welcome &amp; setup
+• /sheet - Get your Google Sheet
+• /summary - This month's spending (/summary refresh after editing the sheet)
+• /help - This help message
+
+💡 <b>Pro Tips:</b>
+• I understand natural language!
+• Screenshots work great for UPI payments
+• Ask me anything - I'm powered by AI!
+"""
+
+@functools.lru_cache(maxsize=256)
+def build_category_management_keyboard(category_items):
+    """Build the category management keyboard once per distinct (category, emoji) set"""
+    # Category buttons two per row
+    buttons = [InlineKeyboardButton(f"{emoji} {category_title(cat)}", callback_data=f"cat_detail_{cat}")
+               for cat, emoji in category_items]
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    
+    # Management options
+    keyboard.extend([
+        [InlineKeyboardButton("➕ Add New Category", callback_data="add_category"),
+         InlineKeyboardButton("🤖 AI Suggestions", callback_data="ai_categories")],
+        [InlineKeyboardButton("📊 Usage Analytics", callback_data="category_analytics")]
+    ])
+    return InlineKeyboardMarkup(keyboard)
+
 def create_approval_keyboard(expense_id):
     """Create expense approval keyboard"""
     return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("✅ Approve", callback_data=f"approve_{expense_id}"),
-            InlineKeyboardButton("✏️ Edit", callback_data=f"edit_{expense_id}"),
-            InlineKeyboardButton("❌ Reject", callback_data=f"reject_{expense_id}")
-        ]
+        [InlineKeyboardButton(label, callback_data=f"{prefix}{expense_id}") for label, prefix in APPROVAL_BUTTONS]
+    ])
+
+@functools.lru_cache(maxsize=2048)
+def create_cancel_edit_keyboard(expense_id):
+    """Create the cancel keyboard shown while an expense is being edited (markups are immutable, so shared)"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("❌ Cancel Edit", callback_data=f"cancel_edit_conversation_{expense_id}")]
+    ])
+
+@functools.lru_cache(maxsize=2048)
+def create_save_cancel_keyboard(expense_id):
+    """Create the save/cancel keyboard shown once an edit is complete"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("💾 Save Changes", callback_data=f"save_expense_{expense_id}"),
+         InlineKeyboardButton("❌ Cancel Edit", callback_data=f"cancel_edit_conversation_{expense_id}")]
     ])
 
 # REMOVED: This function is no longer used for the simplified edit flow
@@ -674,12 +1577,7 @@ def create_approval_keyboard(expense_id):
 
 def create_main_menu_keyboard():
     """Create main menu keyboard"""
-    keyboard = [
-        [KeyboardButton("📊 View Sheet"), KeyboardButton("📂 Categories")],
-        [KeyboardButton("📈 Summary"), KeyboardButton("❓ Help")],
-        [KeyboardButton("🤖 Chat with AI")]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    return MAIN_MENU_KEYBOARD
 
 async def handle_add_category_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle text input during the add category flow."""
@@ -687,11 +1585,11 @@ async def handle_add_category_input(update: Update, context: ContextTypes.DEFAUL
     message_text = update.message.text
     user_state = user_states.get(user_id)
 
-    if not user_state or user_state.get('state') != ADDING_CATEGORY:
+    if not user_state or user_state.state != ADDING_CATEGORY:
         await update.message.reply_text("🤔 No active category creation session. Please use '📂 Categories' → '➕ Add New Category'.")
         return
 
-    current_step = user_state.get('step')
+    current_step = user_state.step
     
     try:
         if current_step == ADDING_CATEGORY_NAME:
@@ -700,26 +1598,26 @@ async def handle_add_category_input(update: Update, context: ContextTypes.DEFAUL
             if not category_name or len(category_name) > 50:
                 await update.message.reply_text(
                     "❌ Category name should be 1-50 characters. Please send a valid name:",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data="cancel_add_category")]])
+                    reply_markup=CANCEL_ADD_CATEGORY_KEYBOARD
                 )
                 return
             
-            categories = get_user_categories(user_id)
-            if category_name in categories:
+            existing_categories = user_state.existing_categories or get_user_categories(user_id)
+            if category_name in existing_categories:
                 await update.message.reply_text(
-                    f"❌ Category '{category_name.title()}' already exists! Please choose a different name:",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data="cancel_add_category")]])
+                    f"❌ Category '{category_title(category_name)}' already exists! Please choose a different name:",
+                    reply_markup=CANCEL_ADD_CATEGORY_KEYBOARD
                 )
                 return
             
             # Store category name and move to emoji step
-            user_states[user_id]['category_name'] = category_name
-            user_states[user_id]['step'] = ADDING_CATEGORY_EMOJI
+            user_states[user_id].category_name = category_name
+            user_states[user_id].step = ADDING_CATEGORY_EMOJI
             
             await update.message.reply_text(
-                f"✅ Category name: '{category_name.title()}'\n\n"
+                f"✅ Category name: '{category_title(category_name)}'\n\n"
                 "Now send me an emoji for this category (e.g., 🍕, 🚗, 💊):",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data="cancel_add_category")]])
+                reply_markup=CANCEL_ADD_CATEGORY_KEYBOARD
             )
             
         elif current_step == ADDING_CATEGORY_EMOJI:
@@ -728,15 +1626,15 @@ async def handle_add_category_input(update: Update, context: ContextTypes.DEFAUL
             if len(emoji) > 5 or not emoji:  # Basic validation
                 emoji = "📝"  # Default emoji if invalid
             
-            user_states[user_id]['category_emoji'] = emoji
-            user_states[user_id]['step'] = ADDING_CATEGORY_KEYWORDS
+            user_states[user_id].category_emoji = emoji
+            user_states[user_id].step = ADDING_CATEGORY_KEYWORDS
             
             await update.message.reply_text(
                 f"✅ Emoji: {emoji}\n\n"
                 "Finally, send me some keywords for automatic detection (comma-separated).\n"
                 "Example: 'pizza, restaurant, dominos, food delivery'\n"
                 "Or send 'none' to skip:",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data="cancel_add_category")]])
+                reply_markup=CANCEL_ADD_CATEGORY_KEYBOARD
             )
             
         elif current_step == ADDING_CATEGORY_KEYWORDS:
@@ -746,11 +1644,10 @@ async def handle_add_category_input(update: Update, context: ContextTypes.DEFAUL
                 keywords = [k.strip().lower() for k in message_text.split(',') if k.strip()]
             
             # Create the category
-            category_name = user_states[user_id]['category_name']
-            category_emoji = user_states[user_id]['category_emoji']
+            category_name = user_states[user_id].category_name
+            category_emoji = user_states[user_id].category_emoji
             
-            categories = get_user_categories(user_id)
-            categories[category_name] = {
+            get_editable_categories(user_id)[category_name] = {
                 'emoji': category_emoji,
                 'keywords': keywords
             }
@@ -761,7 +1658,7 @@ async def handle_add_category_input(update: Update, context: ContextTypes.DEFAUL
             
             await update.message.reply_text(
                 f"🎉 **Category Created Successfully!**\n\n"
-                f"{category_emoji} **{category_name.title()}**\n"
+                f"{category_emoji} **{category_title(category_name)}**\n"
                 f"Keywords: {', '.join(keywords) if keywords else 'None'}\n\n"
                 "Your new category is ready to use!"
             )
@@ -770,7 +1667,7 @@ async def handle_add_category_input(update: Update, context: ContextTypes.DEFAUL
         logger.error(f"❌ handle_add_category_input error: {e}")
         await update.message.reply_text(
             "❌ Error processing category input. Please try again or cancel.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data="cancel_add_category")]])
+            reply_markup=CANCEL_ADD_CATEGORY_KEYBOARD
         )
 
 # Enhanced message handlers
@@ -782,52 +1679,28 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Initialize user data
         get_user_categories(user_id)
-        get_user_sheet(user_id)
+        await run_sheets_call(get_user_sheet, user_id)
         
         # Send initial welcome
         await update.message.reply_text(
-            f"🎉 **Welcome {user.first_name}!**\n\n"
+            f"🎉 <b>Welcome {html.escape(user.first_name)}!</b>\n\n"
             f"I'm your AI-powered expense tracking assistant! Let me show you how easy it is to track expenses...",
+            parse_mode=ParseMode.HTML,
             reply_markup=create_main_menu_keyboard()
         )
         
-        # Send screenshot demo
-        demo_message = """
-📸 **Try This Right Now:**
-
-**Option 1 - Upload a Screenshot:**
-• Take a screenshot of any UPI payment 
-• Send it to me - I'll extract all details automatically!
-
-**Option 2 - Type an Expense:**
-• Just type: "Lunch ₹350 at McDonald's"
-• Or: "Uber ride ₹150"
-• Or: "Grocery ₹2500"
-
-**What I'll do:**
-✅ Extract amount, merchant, category
-✅ Save to your personal Google Sheet
-✅ Smart categorization with AI
-✅ Interactive editing if needed
-
-**Ready to try?** Send me any expense! 🚀
-"""
-        
-        await update.message.reply_text(demo_message)
-        
-        # Send quick demo of sheet access
-        if str(user_id) in user_sheets:
-            sheet_url = get_sheet_url(user_id)
-            if sheet_url:
-                await update.message.reply_text(
-                    f"📊 **Your Google Sheet is ready!**\n\n"
-                    f"🔗 [Open My Sheet]({sheet_url})\n\n"
-                    f"All your expenses will be automatically saved here with full edit access!"
-                )
-        else:
-            await update.message.reply_text(
-                "💡 **First expense?** Your personal Google Sheet will be created automatically when you send your first expense!"
+        # Screenshot demo and sheet access go out as one message to save a round trip
+        sheet_url = get_sheet_url(user_id)
+        if sheet_url:
+            sheet_message = (
+                f"📊 <b>Your Google Sheet is ready!</b>\n\n"
+                f"🔗 <a href=\"{html.escape(sheet_url)}\">Open My Sheet</a>\n\n"
+                f"All your expenses will be automatically saved here with full edit access!"
             )
+        else:
+            sheet_message = "💡 <b>First expense?</b> Your personal Google Sheet will be created automatically when you send your first expense!"
+        
+        await update.message.reply_text(f"{DEMO_MESSAGE_HTML}\n{sheet_message}", parse_mode=ParseMode.HTML)
         
         logger.info(f"✅ Enhanced welcome sent to: {user_id} ({user.first_name})")
         
@@ -847,25 +1720,46 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         message_text = update.message.text
         
         # Handle menu buttons first
-        if message_text in ["📊 View Sheet", "📂 Categories", "📈 Summary", "❓ Help"]:
+        if message_text in MENU_BUTTONS:
             await handle_menu_button(update, context, message_text)
             return
         
-        # Let Gemini analyze the intent
-        await update.message.reply_text("🤖 Analyzing your message...")
+        # Looked up once and handed down to the handlers below
+        categories = get_user_categories(user_id)
+        
+        # Plain "₹250 uber"-style expenses need neither intent analysis nor AI parsing
+        local_expense = parse_expense_locally(message_text, categories)
+        if local_expense:
+            await handle_expense_text(update, context, message_text,
+                                      {"intent": "expense", "expense_detected": True, "local_expense": local_expense},
+                                      categories)
+            return
+        
+        # "₹420 dinner with friends" is clearly an expense even without a known keyword
+        if len(message_text) < EXPENSE_HINT_MAX_LEN and AMOUNT_RE.search(message_text):
+            await handle_expense_text(update, context, message_text,
+                                      {"intent": "expense", "expense_detected": True}, categories)
+            return
         
         user_context = {
             "user_id": user_id,
             "has_sheet": str(user_id) in user_sheets,
-            "categories": list(get_user_categories(user_id).keys())
+            "categories": list(categories)
         }
         
-        intent_data = await GeminiDecisionEngine.analyze_user_intent(message_text, user_context)
+        # Common requests are recognised locally; only ambiguous text goes to Gemini
+        intent = quick_intent(message_text)
+        if intent:
+            intent_data = {"intent": intent, "confidence": 1.0, "expense_detected": False}
+        else:
+            # Let Gemini analyze the intent
+            await update.message.reply_text("🤖 Analyzing your message...")
+            intent_data = await GeminiDecisionEngine.analyze_user_intent(message_text, user_context)
         logger.info(f"Intent analysis for user {user_id}: {intent_data}")
         
         # Handle based on intent
         if intent_data["intent"] == "expense" and intent_data["expense_detected"]:
-            await handle_expense_text(update, context, message_text, intent_data)
+            await handle_expense_text(update, context, message_text, intent_data, categories)
         elif intent_data["intent"] in ["question", "help", "greeting", "complaint"]:
             ai_response = await GeminiDecisionEngine.generate_smart_response(
                 message_text, intent_data, user_context
@@ -887,40 +1781,45 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             
     except Exception as e:
-        logger.error(f"❌ Text handling error: {e}\n{traceback.format_exc()}")
+        logger.error("❌ Text handling error: %s", e, exc_info=True)
         await update.message.reply_text(
             "😅 I encountered an issue. Let me try again! Could you please resend your message?"
         )
 
-async def handle_expense_text(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, intent_data: dict):
+async def handle_expense_text(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, intent_data: dict,
+                              categories: dict = None):
     """Handle expense text with AI parsing"""
     try:
         user_id = update.effective_user.id
-        categories = get_user_categories(user_id)
+        if categories is None:
+            categories = get_user_categories(user_id)
         
-        # Parse expense using AI
-        expense_data = await GeminiDecisionEngine.parse_expense_with_ai(text, user_id, categories)
+        expense_data = intent_data.get('local_expense') or parse_expense_locally(text, categories)
+        if not expense_data:
+            # The user's own keywords are cheaper and more reliable than the AI's category pick
+            local_category = local_categorize(text, categories)
+            
+            # Parse expense using AI
+            expense_data = await GeminiDecisionEngine.parse_expense_with_ai(text, user_id, categories)
+            if expense_data and local_category:
+                expense_data['category'] = local_category
         
         if expense_data and expense_data.get('amount'):
-            expense_id = f"exp_{user_id}_{int(datetime.now().timestamp())}"
+            expense_id = f"exp_{user_id}_{next(expense_counter)}"
             pending_expenses[expense_id] = expense_data
             
             category_emoji = categories.get(expense_data['category'], {}).get('emoji', '📝')
             
-            response = f"""
-💰 **Expense Detected**
-
-**Amount:** ₹{expense_data['amount']}
-**Category:** {category_emoji} {expense_data['category'].title()}
-**Merchant:** {expense_data.get('merchant', 'Unknown')}
-**Payment:** {expense_data.get('payment_method', 'unknown').upper()}
-**Date:** {expense_data.get('date')}
-
-**AI Confidence:** {expense_data.get('confidence', 'N/A')}
-**Notes:** {expense_data.get('extraction_notes', 'Auto-detected')}
-
-Please review and approve:
-"""
+            response = EXPENSE_TEMPLATE.format(
+                amount=expense_data['amount'],
+                category_emoji=category_emoji,
+                category=category_title(expense_data['category']),
+                merchant=expense_data.get('merchant', 'Unknown'),
+                payment_method=expense_data.get('payment_method', 'unknown').upper(),
+                date=expense_data.get('date'),
+                confidence=expense_data.get('confidence', 'N/A'),
+                notes=expense_data.get('extraction_notes', 'Auto-detected')
+            )
             
             await update.message.reply_text(
                 response,
@@ -951,10 +1850,12 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Download image
         photo = update.message.photo[-1]
         file = await context.bot.get_file(photo.file_id)
-        image_bytes = await file.download_as_bytearray()
+        # Downloaded straight into a buffer PIL can read, without an intermediate bytearray copy
+        image_file = BytesIO()
+        await file.download_to_memory(image_file)
         
         # Process with AI
-        image_result = await GeminiDecisionEngine.process_image_with_ai(image_bytes)
+        image_result = await GeminiDecisionEngine.process_image_with_ai(image_file)
         
         if image_result and image_result.get('parsed_data'):
             # REMOVED: Display of raw extracted text
@@ -980,22 +1881,19 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     'confidence': parsed_data.get('confidence', 0.8)
                 }
                 
-                expense_id = f"exp_{user_id}_{int(datetime.now().timestamp())}"
+                expense_id = f"exp_{user_id}_{next(expense_counter)}"
                 pending_expenses[expense_id] = expense_data
                 
-                response = f"""
-📱 **From Screenshot:**
-
-**Amount:** ₹{expense_data['amount']}
-**Merchant:** {expense_data['merchant']}
-**Payment:** {expense_data['payment_method'].upper()}
-**Transaction ID:** {parsed_data.get('transaction_id', 'Not found')}
-
-Please review and approve:
-"""
+                response = SCREENSHOT_TEMPLATE_HTML.format(
+                    amount=html.escape(str(expense_data['amount'])),
+                    merchant=html.escape(str(expense_data['merchant'])),
+                    payment_method=html.escape(str(expense_data['payment_method']).upper()),
+                    transaction_id=html.escape(str(parsed_data.get('transaction_id', 'Not found')))
+                )
                 
                 await update.message.reply_text(
                     response,
+                    parse_mode=ParseMode.HTML,
                     reply_markup=create_approval_keyboard(expense_id)
                 )
             else:
@@ -1013,7 +1911,7 @@ Please review and approve:
             )
             
     except Exception as e:
-        logger.error(f"❌ Photo processing error: {e}\n{traceback.format_exc()}")
+        logger.error("❌ Photo processing error: %s", e, exc_info=True)
         await update.message.reply_text(
             "📸 Error processing image. Please try again or type the expense manually."
         )
@@ -1041,11 +1939,11 @@ async def get_sheet_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if str(user_id) in user_sheets:
             sheet_url = f"https://docs.google.com/spreadsheets/d/{user_sheets[str(user_id)]}"
             
-            # AI-generated sheet message
+            # AI-generated sheet message; the URL is appended below so the reply is shared by every user
             sheet_response = await GeminiDecisionEngine.generate_smart_response(
                 "User wants their Google Sheet link",
                 {"intent": "sheet_request"},
-                {"sheet_url": sheet_url}
+                {"has_sheet": True}
             )
             
             message = f"{sheet_response}\n\n🔗 **Your Sheet:** {sheet_url}"
@@ -1069,40 +1967,20 @@ async def manage_categories(update: Update, context: ContextTypes.DEFAULT_TYPE):
         message = "📂 **Category Management**\n\n"
         message += "**Manage your categories:**"
         
-        # Create category buttons
-        keyboard = []
-        row = []
-        
-        for cat, cat_data in categories.items():
-            emoji = cat_data.get('emoji', '📝')
-            button_text = f"{emoji} {cat.title()}"
-            button = InlineKeyboardButton(button_text, callback_data=f"cat_detail_{cat}")
-            row.append(button)
-            
-            if len(row) == 2:
-                keyboard.append(row)
-                row = []
-        
-        if row:
-            keyboard.append(row)
-        
-        # Management options
-        keyboard.extend([
-            [InlineKeyboardButton("➕ Add New Category", callback_data="add_category"),
-             InlineKeyboardButton("🤖 AI Suggestions", callback_data="ai_categories")],
-            [InlineKeyboardButton("📊 Usage Analytics", callback_data="category_analytics")]
-        ])
+        keyboard = build_category_management_keyboard(
+            tuple((cat, cat_data.get('emoji', '📝')) for cat, cat_data in categories.items())
+        )
         
         # Determine if it's a new message or an edit to an existing one
         if update.callback_query:
             await update.callback_query.edit_message_text(
                 message,
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=keyboard
             )
         else:
             await update.message.reply_text(
                 message,
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=keyboard
             )
         
     except Exception as e:
@@ -1114,42 +1992,31 @@ async def monthly_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
         
-        sheet = get_user_sheet(user_id)
-        if not sheet:
+        # "/summary refresh" recomputes the totals from the sheet after manual edits
+        rebuild = bool(context.args) and context.args[0].lower() == 'refresh'
+        aggregates = await run_sheets_call(get_user_aggregates, user_id, rebuild)
+        if aggregates is None:
             await update.message.reply_text("❌ Error accessing your expense data.")
             return
         
-        # Get current month data
+        # Current month totals are kept up to date as expenses are written
         current_month = datetime.now().strftime('%Y-%m')
-        all_records = sheet.get_all_records()
-        
-        # Filter current month expenses
-        month_expenses = [r for r in all_records if str(r.get('Date', '')).startswith(current_month)]
-        
-        if not month_expenses:
+        month_totals = aggregates.get(current_month)
+        if not month_totals or not month_totals['count']:
             await update.message.reply_text(f"📊 No expenses found for {datetime.now().strftime('%B %Y')}")
             return
         
-        # Calculate summary data
-        # Ensure 'Amount' column is used, not 'Amount (₹)' as per the sheet headers
-        total_amount = sum(float(r.get('Amount', 0)) for r in month_expenses) 
-        categories = get_user_categories(user_id)
-        
-        category_totals = {}
-        payment_method_totals = {}
+        total_amount = month_totals['total']
+        transaction_count = month_totals['count']
+        category_totals = month_totals['category']
+        payment_method_totals = month_totals['payment_method']
         
-        for expense in month_expenses:
-            cat = expense.get('Category', 'miscellaneous')
-            payment = expense.get('Payment Method', 'unknown')
-            amount = float(expense.get('Amount', 0)) # Ensure 'Amount' column is used
-            
-            category_totals[cat] = category_totals.get(cat, 0) + amount
-            payment_method_totals[payment] = payment_method_totals.get(payment, 0) + amount
+        categories = get_user_categories(user_id)
         
         # Generate AI insights
         summary_data = {
             "total_amount": total_amount,
-            "transaction_count": len(month_expenses),
+            "transaction_count": transaction_count,
             "category_breakdown": category_totals,
             "payment_methods": payment_method_totals,
             "month": datetime.now().strftime('%B %Y')
@@ -1166,17 +2033,17 @@ async def monthly_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📈 **{datetime.now().strftime('%B %Y')} Summary**
 
 💰 **Total Spent:** ₹{total_amount:,.2f}
-📝 **Transactions:** {len(month_expenses)}
+📝 **Transactions:** {transaction_count}
 
 📊 **Top Categories:**
 """
         
         # Top 5 categories
-        sorted_categories = sorted(category_totals.items(), key=lambda x: x[1], reverse=True)[:5]
+        sorted_categories = heapq.nlargest(5, category_totals.items(), key=lambda x: x[1])
         for cat, amount in sorted_categories:
             emoji = categories.get(cat, {}).get('emoji', '📝')
             percentage = (amount / total_amount) * 100
-            summary += f"{emoji} {cat.title()}: ₹{amount:,.0f} ({percentage:.1f}%)\n"
+            summary += f"{emoji} {category_title(cat)}: ₹{amount:,.0f} ({percentage:.1f}%)\n"
         
         summary += f"\n🤖 **AI Insights:**\n{ai_insights}"
         
@@ -1187,7 +2054,7 @@ async def monthly_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(summary)
         
     except Exception as e:
-        logger.error(f"❌ Summary error: {e}\n{traceback.format_exc()}")
+        logger.error("❌ Summary error: %s", e, exc_info=True)
         await update.message.reply_text("❌ Error generating summary. Please try again.")
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1206,26 +2073,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         
         # Add specific examples
-        help_text = f"""{help_response}
-
-📝 **Expense Examples:**
-• "Lunch ₹350 at McDonald's"
-• "Uber ride ₹150"
-• "Grocery shopping ₹2500 at BigBazaar"
-• Upload UPI/payment screenshots
-
-🎛️ **Commands:**
-• /start - Welcome & setup
-• /sheet - Get your Google Sheet
-• /help - This help message
-
-💡 **Pro Tips:**
-• I understand natural language!
-• Screenshots work great for UPI payments
-• Ask me anything - I'm powered by AI!
-"""
-        
-        await update.message.reply_text(help_text)
+        await update.message.reply_text(html.escape(help_response) + HELP_TEXT_HTML, parse_mode=ParseMode.HTML)
         
     except Exception as e:
         logger.error(f"❌ Help command error: {e}")
@@ -1255,7 +2103,7 @@ async def handle_category_callback(query, category_data_str: str):
         if action == "detail":
             if category_name in categories:
                 cat_info = categories[category_name]
-                message = f"📂 **Category: {cat_info.get('emoji', '')} {category_name.title()}**\n\n"
+                message = f"📂 **Category: {cat_info.get('emoji', '')} {category_title(category_name)}**\n\n"
                 message += f"**Emoji:** {cat_info.get('emoji', 'N/A')}\n"
                 message += f"**Keywords:** {', '.join(cat_info.get('keywords', ['None']))}\n\n"
                 
@@ -1265,42 +2113,39 @@ async def handle_category_callback(query, category_data_str: str):
                 ])
                 await query.edit_message_text(message, reply_markup=keyboard)
             else:
-                await query.edit_message_text(f"❌ Category '{category_name.title()}' not found.")
+                await query.edit_message_text(f"❌ Category '{category_title(category_name)}' not found.")
         else:
             await query.edit_message_text(f"Unhandled category action: {action}")
 
     except Exception as e:
-        logger.error(f"❌ handle_category_callback error: {e}\n{traceback.format_exc()}")
+        logger.error("❌ handle_category_callback error: %s", e, exc_info=True)
         await query.edit_message_text("❌ Error getting category details. Please try again.")
 
 # NEW: handle_add_category implementation
 async def handle_add_category(query):
     """Initiates the process of adding a new category."""
     user_id = query.from_user.id
-    user_states[user_id] = {'state': ADDING_CATEGORY, 'step': ADDING_CATEGORY_NAME}
-    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data="cancel_add_category")]])
-    await query.edit_message_text("Let's add a new category! Please send me the **name** for your new category (e.g., 'Subscriptions').", reply_markup=keyboard)
+    # Names are checked against this snapshot on every retry instead of refetching the categories
+    user_states[user_id] = UserState(state=ADDING_CATEGORY, step=ADDING_CATEGORY_NAME,
+                                     existing_categories=frozenset(get_user_categories(user_id)))
+    await query.edit_message_text("Let's add a new category! Please send me the **name** for your new category (e.g., 'Subscriptions').", reply_markup=CANCEL_ADD_CATEGORY_KEYBOARD)
 
 # NEW: handle_category_analytics implementation
 async def handle_category_analytics(query):
     """Fetches and displays usage analytics by category."""
     try:
         user_id = query.from_user.id
-        sheet = get_user_sheet(user_id)
-        if not sheet:
+        aggregates = await run_sheets_call(get_user_aggregates, user_id)
+        if aggregates is None:
             await query.edit_message_text("❌ Error accessing your expense data for analytics.")
             return
 
-        all_records = sheet.get_all_records()
-        if not all_records:
+        lifetime_totals = aggregates.get('_all')
+        if not lifetime_totals or not lifetime_totals['count']:
             await query.edit_message_text("📊 No expenses recorded yet to generate analytics.")
             return
 
-        category_totals = {}
-        for expense in all_records:
-            cat = expense.get('Category', 'miscellaneous')
-            amount = float(expense.get('Amount', 0)) # Assuming 'Amount' is the column name
-            category_totals[cat] = category_totals.get(cat, 0) + amount
+        category_totals = lifetime_totals['category']
         
         total_spent = sum(category_totals.values())
 
@@ -1319,7 +2164,7 @@ async def handle_category_analytics(query):
         for cat, amount in sorted_categories:
             emoji = categories_info.get(cat, {}).get('emoji', '📝')
             percentage = (amount / total_spent) * 100 if total_spent > 0 else 0
-            message += f"{emoji} **{cat.title()}:** ₹{amount:,.2f} ({percentage:.1f}%)\n"
+            message += f"{emoji} **{category_title(cat)}:** ₹{amount:,.2f} ({percentage:.1f}%)\n"
         
         message += f"\n**Total Expenses Tracked:** ₹{total_spent:,.2f}"
         
@@ -1329,7 +2174,7 @@ async def handle_category_analytics(query):
         await query.edit_message_text(message, reply_markup=keyboard)
 
     except Exception as e:
-        logger.error(f"❌ handle_category_analytics error: {e}\n{traceback.format_exc()}")
+        logger.error("❌ handle_category_analytics error: %s", e, exc_info=True)
         await query.edit_message_text("❌ Error generating category analytics. Please try again.")
 
 async def handle_robust_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1339,114 +2184,86 @@ async def handle_robust_callback(update: Update, context: ContextTypes.DEFAULT_T
         await query.answer()
         
         data = query.data
-        user_id = query.from_user.id
-        
-        # Clean up expired sessions periodically
-        edit_session_manager.cleanup_expired_sessions()
         
         # REMOVED: handle_edit_field_callback and set_category/payment callbacks
         # as editing is now chat-based for amount and category.
-        # if data.startswith("edit_field_"):
-        #     await handle_edit_field_callback(query, data)
-        # elif data.startswith("set_category_"):
-        #     ...
-        # elif data.startswith("set_payment_"):
-        #     ...
-            
-        if data.startswith("confirm_edit_"):
-            # This path is likely deprecated by direct save_expense_ logic
-            pass 
-        elif data.startswith("cancel_edit"): # This handles cancel for both add and edit flows
-            # Check for specific cancel_edit_expense_id for edit flow
-            if data.startswith("cancel_edit_exp_"):
-                expense_id_to_cancel = data.replace("cancel_edit_", "")
-                edit_session_manager.cleanup_user_sessions(user_id) # Clean up the edit session
-                if expense_id_to_cancel in pending_expenses:
-                    del pending_expenses[expense_id_to_cancel] # Remove from pending if it was there
-                await query.edit_message_text("❌ Expense editing cancelled.")
-            # Check for general cancel for add category flow
-            elif data == "cancel_add_category":
-                if user_id in user_states and user_states[user_id].get('state') == ADDING_CATEGORY:
-                    del user_states[user_id] # Clear ADDING_CATEGORY state
-                    await query.edit_message_text("❌ New category creation cancelled.")
-                    await manage_categories(update, context) # Go back to category menu
-            # NEW: Handle cancel during chat-based expense editing
-            elif data.startswith("cancel_edit_conversation_"):
-                expense_id_to_cancel = data.replace("cancel_edit_conversation_", "")
-                edit_session_manager.cleanup_user_sessions(user_id)
-                if user_id in user_states:
-                    del user_states[user_id] # Clear user state
-                await query.edit_message_text("❌ Expense editing cancelled.")
-            else: # Generic cancel, e.g., from AI suggestions
-                if user_id in user_states:
-                    del user_states[user_id]
-                await query.edit_message_text("Okay, cancelled.")
-            
-        elif data.startswith("save_expense_"):
-            await handle_save_expense_callback(query, data)
         
-        # Handle approval actions
-        elif data.startswith(("approve_", "edit_", "reject_")):
-            await handle_expense_callback(query, data)
-            
-        # Handle category actions (e.g., cat_detail_food)
-        elif data.startswith("cat_"):
-            category_detail_string = data[4:] # e.g., "detail_food"
-            await handle_category_callback(query, category_detail_string)
-            
-        # Handle special actions
-        elif data == "add_category":
-            await handle_add_category(query)
-            
-        elif data == "ai_categories":
-            await handle_ai_category_suggestions(query)
+        # Fixed callback strings hit the table directly; the rest route on their first word
+        handler = CALLBACK_HANDLERS.get(data)
+        if handler is None:
+            prefix, handler = CALLBACK_PREFIX_HANDLERS.get(data.partition('_')[0], ('', None))
+            if not data.startswith(prefix):
+                handler = None
+        if handler:
+            await handler(update, context, query, data)
+
+    except Exception as e:
+        logger.error("❌ Robust callback error: %s", e, exc_info=True)
+        await edit_coalescer.send_now(query, "❌ Error processing request. Please try again.")
+
+async def handle_cancel_edit_callback(update, context, query, data):
+    """Cancel an expense edit, either a session edit or the chat-based conversation"""
+    user_id = query.from_user.id
+    if data.startswith("cancel_edit_exp_"):
+        expense_id_to_cancel = data.replace("cancel_edit_", "")
+        edit_session_manager.cleanup_user_sessions(user_id) # Clean up the edit session
+        pending_expenses.pop(expense_id_to_cancel, None) # Remove from pending if it was there
+        await query.edit_message_text("❌ Expense editing cancelled.")
+    # NEW: Handle cancel during chat-based expense editing
+    elif data.startswith("cancel_edit_conversation_"):
+        edit_session_manager.cleanup_user_sessions(user_id)
+        user_states.pop(user_id, None) # Clear user state
+        await query.edit_message_text("❌ Expense editing cancelled.")
+    else: # Generic cancel, e.g., from AI suggestions
+        user_states.pop(user_id, None)
+        await query.edit_message_text("Okay, cancelled.")
+
+async def handle_cancel_add_category_callback(update, context, query, data):
+    """Cancel the add category flow and go back to the category menu"""
+    user_id = query.from_user.id
+    if user_id in user_states and user_states[user_id].state == ADDING_CATEGORY:
+        del user_states[user_id] # Clear ADDING_CATEGORY state
+        await query.edit_message_text("❌ New category creation cancelled.")
+        await manage_categories(update, context) # Go back to category menu
+
+async def handle_add_ai_category_callback(update, context, query, data):
+    """Add the AI suggested category picked by the user"""
+    user_id = query.from_user.id
+    suggestion_index = int(data.split('_')[-1])
+    if user_id in user_states and user_states[user_id].ai_suggestions is not None:
+        suggestions = user_states[user_id].ai_suggestions
+        if 0 <= suggestion_index < len(suggestions):
+            suggestion = suggestions[suggestion_index]
+            categories = get_user_categories(user_id)
             
-        # NEW: Handlers for AI category suggestions confirmation/cancel
-        elif data.startswith("add_ai_cat_"):
-            suggestion_index = int(data.split('_')[-1])
-            if user_id in user_states and 'ai_suggestions' in user_states[user_id]:
-                suggestions = user_states[user_id]['ai_suggestions']
-                if 0 <= suggestion_index < len(suggestions):
-                    suggestion = suggestions[suggestion_index]
-                    categories = get_user_categories(user_id)
-                    
-                    # Ensure category name is lowercase for consistency
-                    cat_name_lower = suggestion['name'].lower()
-                    if cat_name_lower not in categories:
-                        categories[cat_name_lower] = {
-                            'emoji': suggestion['emoji'], 
-                            'keywords': suggestion['keywords']
-                        }
-                        save_categories()
-                        await query.edit_message_text(f"✅ Category '{suggestion['name'].title()}' added!")
-                    else:
-                        await query.edit_message_text(f"💡 Category '{suggestion['name'].title()}' already exists!")
-                    
-                    del user_states[user_id]['ai_suggestions'] # Clean up AI suggestions state
-                    if user_id in user_states and user_states[user_id].get('state') == ADDING_CATEGORY:
-                        del user_states[user_id] # Also clear ADDING_CATEGORY state if active
-                else:
-                    await query.edit_message_text("Error: Invalid AI suggestion index.")
+            # Ensure category name is lowercase for consistency
+            cat_name_lower = suggestion['name'].lower()
+            if cat_name_lower not in categories:
+                get_editable_categories(user_id)[cat_name_lower] = {
+                    'emoji': suggestion['emoji'], 
+                    'keywords': suggestion['keywords']
+                }
+                save_categories()
+                await query.edit_message_text(f"✅ Category '{category_title(suggestion['name'])}' added!")
             else:
-                await query.edit_message_text("Error: Could not retrieve AI suggestions. Please try '🤖 AI Suggestions' again.")
-        elif data == "cancel_ai_cats":
-            if user_id in user_states and 'ai_suggestions' in user_states[user_id]:
-                del user_states[user_id]['ai_suggestions']
-            await query.edit_message_text("AI category suggestions cancelled.")
-            if user_id in user_states and user_states[user_id].get('state') == ADDING_CATEGORY:
-                del user_states[user_id] # Also clear ADDING_CATEGORY state if active
+                await query.edit_message_text(f"💡 Category '{category_title(suggestion['name'])}' already exists!")
             
-        # NEW: Handler for Category Analytics
-        elif data == "category_analytics":
-            await handle_category_analytics(query)
-
-        # NEW: Handler to go back to main category menu
-        elif data == "back_to_categories":
-            await manage_categories(update, context) # Re-call manage_categories to show the menu
+            user_states[user_id].ai_suggestions = None # Clean up AI suggestions state
+            if user_id in user_states and user_states[user_id].state == ADDING_CATEGORY:
+                del user_states[user_id] # Also clear ADDING_CATEGORY state if active
+        else:
+            await query.edit_message_text("Error: Invalid AI suggestion index.")
+    else:
+        await query.edit_message_text("Error: Could not retrieve AI suggestions. Please try '🤖 AI Suggestions' again.")
 
-    except Exception as e:
-        logger.error(f"❌ Robust callback error: {e}\n{traceback.format_exc()}")
-        await query.edit_message_text("❌ Error processing request. Please try again.")
+async def handle_cancel_ai_categories_callback(update, context, query, data):
+    """Drop the pending AI category suggestions"""
+    user_id = query.from_user.id
+    if user_id in user_states and user_states[user_id].ai_suggestions is not None:
+        user_states[user_id].ai_suggestions = None
+    await query.edit_message_text("AI category suggestions cancelled.")
+    if user_id in user_states and user_states[user_id].state == ADDING_CATEGORY:
+        del user_states[user_id] # Also clear ADDING_CATEGORY state if active
 
 # REMOVED: This function is no longer used for the simplified edit flow
 # async def handle_edit_field_callback(query, data):
@@ -1531,16 +2348,12 @@ async def enhanced_handle_message(update: Update, context: ContextTypes.DEFAULT_
     """Enhanced message handler that checks for active edit or add category sessions"""
     try:
         user_id = update.effective_user.id
-        message_text = update.message.text
         
-        # Check if user is in an edit expense conversation
-        if user_id in user_states and user_states[user_id].get('state') == EDITING_EXPENSE:
-            await handle_edit_expense_conversation_input(update, context)
-            return
-        
-        # Check if user is in an add category session
-        if user_id in user_states and user_states[user_id].get('state') == ADDING_CATEGORY:
-            await handle_add_category_input(update, context)
+        # Users in an edit expense or add category session go to that flow's handler
+        user_state = user_states.get(user_id)
+        state_handler = STATE_HANDLERS.get(user_state.state) if user_state else None
+        if state_handler:
+            await state_handler(update, context)
             return
 
         # Otherwise, use the regular text handler
@@ -1557,11 +2370,11 @@ async def handle_edit_expense_conversation_input(update: Update, context: Contex
     message_text = update.message.text
     user_state = user_states.get(user_id)
 
-    if not user_state or user_state.get('state') != EDITING_EXPENSE:
+    if not user_state or user_state.state != EDITING_EXPENSE:
         await update.message.reply_text("🤔 No active expense editing session. Please start editing from the approval message.")
         return
 
-    session_id = user_state.get('session_id')
+    session_id = user_state.session_id
     session = edit_session_manager.sessions.get(session_id)
 
     if not session or session.is_expired():
@@ -1569,32 +2382,51 @@ async def handle_edit_expense_conversation_input(update: Update, context: Contex
         del user_states[user_id]
         return
 
-    current_step = user_state.get('step')
+    current_step = user_state.step
     
     # Keyboard for save/cancel after collecting info
-    save_cancel_keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("💾 Save Changes", callback_data=f"save_expense_{session.expense_id}"),
-         InlineKeyboardButton("❌ Cancel Edit", callback_data=f"cancel_edit_conversation_{session.expense_id}")]
-    ])
-    
-    cancel_keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("❌ Cancel Edit", callback_data=f"cancel_edit_conversation_{session.expense_id}")]
-    ])
+    save_cancel_keyboard = create_save_cancel_keyboard(session.expense_id)
+    cancel_keyboard = create_cancel_edit_keyboard(session.expense_id)
 
     try:
+        # Answer to a "did you mean" category suggestion (the category step is still active)
+        pending_input = user_states[user_id].pending_category_confirmation
+        if pending_input is not None:
+            answer = message_text.strip().lower()
+            if answer in CATEGORY_SUGGESTION_ACCEPT:
+                confirmed_category = user_states[user_id].suggested_category
+                session.update_field('category', confirmed_category, f"User confirmed suggested category via chat: {confirmed_category}")
+                await update.message.reply_text(f"✅ Category updated to '{category_title(confirmed_category)}'.", reply_markup=save_cancel_keyboard)
+                del user_states[user_id] # Clear state after completion
+                return
+            if answer in CATEGORY_SUGGESTION_REJECT:
+                # User rejected suggestion, keep what they originally typed as a new category
+                get_editable_categories(user_id)[pending_input] = {'emoji': '📝', 'keywords': []} # Add as new category
+                save_categories()
+                session.update_field('category', pending_input, f"User added new category (rejected suggestion) via chat: {pending_input}")
+                await update.message.reply_text(f"✅ Category '{category_title(pending_input)}' added as a new category and updated for this expense!", reply_markup=save_cancel_keyboard)
+                del user_states[user_id] # Clear state after completion
+                return
+            # Anything else is a different category name: run the category step on it below
+            user_states[user_id].pending_category_confirmation = None
+            user_states[user_id].suggested_category = None
+
         if current_step == EDITING_AMOUNT:
             try:
-                amount = float(re.findall(r'\d+(?:\.\d+)?', message_text)[0])
+                amount_match = NUMBER_RE.search(message_text)
+                if not amount_match:
+                    raise ValueError("No amount found.")
+                amount = parse_number(amount_match.group())
                 if amount <= 0:
                     raise ValueError("Amount must be positive.")
                 session.update_field('amount', amount, f"User updated amount via chat: {message_text}")
                 
-                user_states[user_id]['step'] = EDITING_CATEGORY
+                user_states[user_id].step = EDITING_CATEGORY
                 await update.message.reply_text(
                     f"✅ Amount updated to ₹{amount}. Now, please send the **new category** for this expense (e.g., 'Groceries', 'Utilities').",
                     reply_markup=cancel_keyboard
                 )
-            except (ValueError, IndexError):
+            except ValueError:
                 await update.message.reply_text(
                     "❌ Invalid amount format. Please send just the number (e.g., 350 or 350.50):",
                     reply_markup=cancel_keyboard
@@ -1609,130 +2441,133 @@ async def handle_edit_expense_conversation_input(update: Update, context: Contex
                 await update.message.reply_text("Category cannot be empty. Please send a valid category name:", reply_markup=cancel_keyboard)
                 return
 
-            # Optionally, you could use AI to suggest closest category if not exact match
             if new_category not in categories:
-                # Simple AI suggestion for non-existent category
-                ai_cat_prompt = f"The user entered '{new_category}' as a category. Their existing categories are: {list(categories.keys())}. Is '{new_category}' a reasonable new category, or is there a very close existing category? Respond with ONLY the most appropriate existing category name (lowercase) or 'NEW_CATEGORY' if it's genuinely new and reasonable."
-                ai_response = model.generate_content(ai_cat_prompt).text.strip()
+                # Closest existing name by string similarity, without an LLM round trip
+                match = process.extractOne(new_category, list(categories), scorer=fuzz.WRatio,
+                                           score_cutoff=CATEGORY_MATCH_CUTOFF)
+                suggested_cat = match[0] if match else None
+                
+                if not suggested_cat and AI_CATEGORY_MATCH and len(new_category) > 12:
+                    ai_cat_prompt = f"The user entered '{new_category}' as a category. Their existing categories are: {list(categories.keys())}. Is '{new_category}' a reasonable new category, or is there a very close existing category? Respond with ONLY the most appropriate existing category name (lowercase) or 'NEW_CATEGORY' if it's genuinely new and reasonable."
+                    ai_response = (await gemini_generate(ai_cat_prompt)).text.strip().lower()
+                    if ai_response in categories:
+                        suggested_cat = ai_response
                 
-                if ai_response.lower() in categories:
-                    suggested_cat = ai_response.lower()
+                if suggested_cat:
                     await update.message.reply_text(
-                        f"🤔 I don't recognize '{new_category.title()}', but perhaps you meant '{suggested_cat.title()}'? "
-                        f"If so, I'll use '{suggested_cat.title()}'. Otherwise, I'll add '{new_category.title()}' as a new category. "
-                        "Confirm by typing 'yes' or send a different category name."
+                        f"🤔 I don't recognize '{category_title(new_category)}', but perhaps you meant '{category_title(suggested_cat)}'? "
+                        f"Reply 'yes' to use '{category_title(suggested_cat)}', 'no' to add '{category_title(new_category)}' as a new category, "
+                        "or send a different category name."
                     )
-                    user_states[user_id]['pending_category_confirmation'] = new_category
-                    user_states[user_id]['suggested_category'] = suggested_cat
-                    return
-                elif ai_response.lower() == 'new_category':
-                    # Add as new category
-                    categories[new_category] = {'emoji': '📝', 'keywords': []} # Default emoji/keywords
-                    save_categories()
-                    session.update_field('category', new_category, f"User added new category via chat: {new_category}")
-                    await update.message.reply_text(f"✅ Category '{new_category.title()}' added as a new category and updated for this expense!", reply_markup=save_cancel_keyboard)
-                    del user_states[user_id] # Clear state after completion
+                    user_states[user_id].pending_category_confirmation = new_category
+                    user_states[user_id].suggested_category = suggested_cat
                     return
                 else:
-                    # Fallback if AI doesn't give clear existing or new_category
-                    categories[new_category] = {'emoji': '📝', 'keywords': []} # Default emoji/keywords
+                    # Add as new category
+                    get_editable_categories(user_id)[new_category] = {'emoji': '📝', 'keywords': []} # Default emoji/keywords
                     save_categories()
                     session.update_field('category', new_category, f"User added new category via chat: {new_category}")
-                    await update.message.reply_text(f"✅ Category '{new_category.title()}' added as a new category and updated for this expense!", reply_markup=save_cancel_keyboard)
+                    await update.message.reply_text(f"✅ Category '{category_title(new_category)}' added as a new category and updated for this expense!", reply_markup=save_cancel_keyboard)
                     del user_states[user_id] # Clear state after completion
                     return
             else:
                 session.update_field('category', new_category, f"User updated category via chat: {new_category}")
-                await update.message.reply_text(f"✅ Category updated to '{new_category.title()}'.", reply_markup=save_cancel_keyboard)
+                await update.message.reply_text(f"✅ Category updated to '{category_title(new_category)}'.", reply_markup=save_cancel_keyboard)
                 del user_states[user_id] # Clear state after completion
                 return
-        
-        # Handle confirmation for suggested category
-        elif 'pending_category_confirmation' in user_states[user_id] and message_text.lower() == 'yes':
-            confirmed_category = user_states[user_id]['suggested_category']
-            session.update_field('category', confirmed_category, f"User confirmed suggested category via chat: {confirmed_category}")
-            await update.message.reply_text(f"✅ Category updated to '{confirmed_category.title()}'.", reply_markup=save_cancel_keyboard)
-            del user_states[user_id] # Clear state after completion
-            return
-        elif 'pending_category_confirmation' in user_states[user_id] and message_text.lower() != 'yes':
-            # User rejected suggestion, treat original input as new category
-            original_input = user_states[user_id]['pending_category_confirmation']
-            categories = get_user_categories(user_id)
-            categories[original_input] = {'emoji': '📝', 'keywords': []} # Add as new category
-            save_categories()
-            session.update_field('category', original_input, f"User added new category (rejected suggestion) via chat: {original_input}")
-            await update.message.reply_text(f"✅ Category '{original_input.title()}' added as a new category and updated for this expense!", reply_markup=save_cancel_keyboard)
-            del user_states[user_id] # Clear state after completion
-            return
 
 
     except Exception as e:
-        logger.error(f"❌ handle_edit_expense_conversation_input error at step {current_step}: {e}\n{traceback.format_exc()}")
+        logger.error("❌ handle_edit_expense_conversation_input error at step %s: %s", current_step, e, exc_info=True)
         await update.message.reply_text("❌ Error processing your input for editing. Please try again or type '/start' to reset.", reply_markup=cancel_keyboard)
-        if user_id in user_states:
-            del user_states[user_id]
+        user_states.pop(user_id, None)
+
+
+# Conversation state -> handler for the text messages sent while it is active
+STATE_HANDLERS = {
+    EDITING_EXPENSE: handle_edit_expense_conversation_input,
+    ADDING_CATEGORY: handle_add_category_input,
+}
+
+def mark_expense_settled(expense_id):
+    """Remember that an expense was approved, rejected or saved"""
+    settled_expenses[expense_id] = True
+    if len(settled_expenses) > SETTLED_EXPENSES_MAX:
+        settled_expenses.popitem(last=False)
 
+def settle_expense(expense_id):
+    """Take an expense out of pending_expenses for approval or rejection; None if it is gone"""
+    expense_data = pending_expenses.pop(expense_id, None)
+    if expense_data is not None:
+        mark_expense_settled(expense_id)
+    return expense_data
 
 async def handle_expense_callback(query, data):
     """Handle expense approval callbacks"""
     try:
         action, expense_id = data.split('_', 1)
         
-        if expense_id not in pending_expenses:
-            await query.edit_message_text("❌ Expense session expired. Please send the expense again.")
+        # Approve and reject claim the expense before any await, so a second tap can't act on it too
+        expense_data = settle_expense(expense_id) if action in ("approve", "reject") else pending_expenses.get(expense_id)
+        if expense_data is None:
+            if expense_id in settled_expenses:
+                logger.info(f"⏭️ Ignoring repeat {action} of settled expense {expense_id}")
+                return
+            edit_coalescer.schedule(query, "❌ Expense session expired. Please send the expense again.")
             return
         
-        expense_data = pending_expenses[expense_id]
         user_id = query.from_user.id
         
         if action == "approve":
             if add_expense_to_sheet(user_id, expense_data, "Approved"):
+                amount = expense_data['amount']
+                merchant = expense_data.get('merchant', 'Unknown')
+                
                 # AI-generated success message
                 success_response = await GeminiDecisionEngine.generate_smart_response(
-                    f"Expense approved: ₹{expense_data['amount']} for {expense_data.get('merchant', 'Unknown')}",
+                    f"Expense approved: ₹{amount} for {merchant}",
                     {"intent": "expense", "action": "approved"},
                     expense_data
                 )
                 
-                await query.edit_message_text(
-                    f"✅ **{success_response}**\n\n"
-                    f"💰 ₹{expense_data['amount']} - {expense_data.get('merchant', 'Unknown')}\n"
-                    f"📂 {expense_data['category'].title()}"
-                )
+                await edit_coalescer.send_now(query, SAVED_EXPENSE_TEMPLATE.format(
+                    response=success_response, amount=amount, merchant=merchant,
+                    category=category_title(expense_data['category'])
+                ))
             else:
-                await query.edit_message_text("❌ Error saving to Google Sheet. Please try again.")
-            del pending_expenses[expense_id]
+                # Keep the expense so Approve can be tapped again
+                settled_expenses.pop(expense_id, None)
+                pending_expenses[expense_id] = expense_data
+                await edit_coalescer.send_now(query, "❌ Error saving to Google Sheet. Please try again.",
+                                              reply_markup=create_approval_keyboard(expense_id))
             
         elif action == "edit":
             # Create a new edit session for this expense
             session = edit_session_manager.create_session(user_id, expense_id, expense_data)
             
             # Set user state for chat-based editing
-            user_states[user_id] = {'state': EDITING_EXPENSE, 'step': EDITING_AMOUNT, 'session_id': session.session_id}
+            user_states[user_id] = UserState(state=EDITING_EXPENSE, step=EDITING_AMOUNT, session_id=session.session_id)
             
             # Prompt for amount directly
-            await query.edit_message_text(
+            edit_coalescer.schedule(query,
                 f"✏️ **Editing Expense:**\n\n"
                 f"💰 Current Amount: ₹{session.expense_data['amount']}\n"
-                f"📂 Current Category: {session.expense_data['category'].title()}\n\n"
+                f"📂 Current Category: {category_title(session.expense_data['category'])}\n\n"
                 f"Please send the **new amount** for this expense (e.g., '350' or '49.99').",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("❌ Cancel Edit", callback_data=f"cancel_edit_conversation_{expense_id}")
-                ]])
+                reply_markup=create_cancel_edit_keyboard(expense_id)
             )
             
         elif action == "reject":
-            del pending_expenses[expense_id]
             reject_response = await GeminiDecisionEngine.generate_smart_response(
                 "User rejected an expense",
                 {"intent": "expense", "action": "rejected"},
                 expense_data
             )
-            await query.edit_message_text(f"❌ {reject_response}")
+            await edit_coalescer.send_now(query, f"❌ {reject_response}")
             
     except Exception as e:
         logger.error(f"❌ Expense callback error: {e}")
-        await query.edit_message_text("❌ Error processing expense. Please try again.")
+        await edit_coalescer.send_now(query, "❌ Error processing expense. Please try again.")
 
 async def handle_save_expense_callback(query, data):
     """Save edited expense to Google Sheet."""
@@ -1743,34 +2578,39 @@ async def handle_save_expense_callback(query, data):
 
         session = edit_session_manager.get_session(user_id)
         if not session or session.expense_id != expense_id:
-            await query.edit_message_text("❌ Edit session expired or invalid. Please try again.")
+            if expense_id in settled_expenses:
+                logger.info(f"⏭️ Ignoring repeat save of settled expense {expense_id}")
+                return
+            edit_coalescer.schedule(query, "❌ Edit session expired or invalid. Please try again.")
             return
 
+        # Close the session before any await, so a second tap on Save can't write the expense twice
         edited_data = session.expense_data
+        edit_session_manager.cleanup_session(session.session_id)
+        pending_expenses.pop(expense_id, None)
+        mark_expense_settled(expense_id)
+        user_states.pop(user_id, None)
         if add_expense_to_sheet(user_id, edited_data, "Edited & Approved"):
+            amount = edited_data['amount']
+            merchant = edited_data.get('merchant', 'Unknown')
+            
             success_response = await GeminiDecisionEngine.generate_smart_response(
-                f"Edited expense saved: ₹{edited_data['amount']} for {edited_data.get('merchant', 'Unknown')}",
+                f"Edited expense saved: ₹{amount} for {merchant}",
                 {"intent": "expense", "action": "edited_and_saved"},
                 edited_data
             )
             
-            await query.edit_message_text(
-                f"✅ **{success_response}**\n\n"
-                f"💰 ₹{edited_data['amount']} - {edited_data.get('merchant', 'Unknown')}\n"
-                f"📂 {edited_data['category'].title()}"
-            )
+            await edit_coalescer.send_now(query, SAVED_EXPENSE_TEMPLATE.format(
+                response=success_response, amount=amount, merchant=merchant,
+                category=category_title(edited_data['category'])
+            ))
         else:
-            await query.edit_message_text("❌ Error saving edited expense to Google Sheet. Please try again.")
-        
-        edit_session_manager.cleanup_session(session.session_id) # Clean up session after saving
-        if expense_id in pending_expenses:
-            del pending_expenses[expense_id] # Also remove from pending if it was there
-        if user_id in user_states:
-            del user_states[user_id] # Clear user state
+            settled_expenses.pop(expense_id, None)
+            await edit_coalescer.send_now(query, "❌ Error saving edited expense to Google Sheet. Please try again.")
 
     except Exception as e:
-        logger.error(f"❌ handle_save_expense_callback error: {e}\n{traceback.format_exc()}")
-        await query.edit_message_text("❌ Error saving edited expense. Please try again.")
+        logger.error("❌ handle_save_expense_callback error: %s", e, exc_info=True)
+        await edit_coalescer.send_now(query, "❌ Error saving edited expense. Please try again.")
 
 async def handle_ai_category_suggestions(query):
     """AI-powered category suggestions"""
@@ -1794,25 +2634,27 @@ Respond with JSON:
 """
         
         try:
-            response = model.generate_content(suggestions_prompt)
-            result = response.text.strip()
-            
-            if '```json' in result:
-                result = result.split('```json')[1].split('```')[0].strip()
-            elif '```' in result:
-                result = result.split('```')[1].split('```')[0].strip()
-            
-            suggestions_data = json.loads(result)
-            suggestions = suggestions_data.get('suggestions', [])
+            # Suggestions depend only on the category set, so users with the same set share them
+            cache_key = ('suggestions', tuple(sorted(current_categories)))
+            cached = ai_cache_get(cache_key)
+            if cached and time.monotonic() - cached[0] < SUGGESTION_CACHE_TTL:
+                suggestions = cached[1]
+            else:
+                response = await gemini_generate(suggestions_prompt)
+                suggestions_data = parse_llm_json(response)
+                suggestions = suggestions_data.get('suggestions', [])
+                if suggestions:
+                    ai_cache_put(cache_key, (time.monotonic(), suggestions))
             
             if suggestions:
                 message = "🤖 **AI Category Suggestions:**\n\n"
                 keyboard = []
                 
                 # Filter out suggestions that already exist in user's categories
+                existing_names = {k.lower() for k in current_categories}
                 filtered_suggestions = [
-                    s for s in suggestions # FIX: Changed 's for s s' to 's for s'
-                    if s['name'].lower() not in [k.lower() for k in current_categories.keys()]
+                    s for s in suggestions
+                    if s['name'].lower() not in existing_names
                 ][:5] # Limit to 5 new suggestions
                 
                 if not filtered_suggestions:
@@ -1824,16 +2666,16 @@ Respond with JSON:
                     emoji = suggestion['emoji']
                     reason = suggestion['reason']
                     
-                    message += f"{emoji} **{name.title()}**\n{reason}\n\n"
+                    message += f"{emoji} **{category_title(name)}**\n{reason}\n\n"
                     keyboard.append([InlineKeyboardButton(
-                        f"Add {emoji} {name.title()}", 
+                        f"Add {emoji} {category_title(name)}", 
                         callback_data=f"add_ai_cat_{i}" # Index refers to filtered_suggestions
                     )])
                 
                 keyboard.append([InlineKeyboardButton("❌ Cancel", callback_data="cancel_ai_cats")])
                 
                 # Store filtered suggestions temporarily for callback
-                user_states[user_id] = {'ai_suggestions': filtered_suggestions}
+                user_states[user_id] = UserState(ai_suggestions=filtered_suggestions)
                 
                 await query.edit_message_text(
                     message,
@@ -1843,18 +2685,39 @@ Respond with JSON:
                 await query.edit_message_text("🤖 Your categories look comprehensive! No additional suggestions at this time.")
                 
         except Exception as e:
-            logger.error(f"AI suggestions generation error: {e}")
+            logger.error("AI suggestions generation error: %s", e, exc_info=True)
             await query.edit_message_text("🤖 Error generating suggestions. Your current categories look good!")
             
     except Exception as e:
-        logger.error(f"❌ AI category suggestions error: {e}")
+        logger.error("❌ AI category suggestions error: %s", e, exc_info=True)
         await query.edit_message_text("❌ Error generating AI suggestions.")
 
+# Callback data -> handler(update, context, query, data) for the fixed button strings
+CALLBACK_HANDLERS = {
+    "add_category": lambda update, context, query, data: handle_add_category(query),
+    "ai_categories": lambda update, context, query, data: handle_ai_category_suggestions(query),
+    "category_analytics": lambda update, context, query, data: handle_category_analytics(query),
+    "back_to_categories": lambda update, context, query, data: manage_categories(update, context),
+    "cancel_add_category": handle_cancel_add_category_callback,
+    "cancel_ai_cats": handle_cancel_ai_categories_callback,
+}
+
+# First word of the callback data -> (full prefix, handler) for the id-carrying buttons
+CALLBACK_PREFIX_HANDLERS = {
+    "cancel": ("cancel_edit", handle_cancel_edit_callback),
+    "save": ("save_expense_", lambda update, context, query, data: handle_save_expense_callback(query, data)),
+    "approve": ("approve_", lambda update, context, query, data: handle_expense_callback(query, data)),
+    "edit": ("edit_", lambda update, context, query, data: handle_expense_callback(query, data)),
+    "reject": ("reject_", lambda update, context, query, data: handle_expense_callback(query, data)),
+    "cat": ("cat_", lambda update, context, query, data: handle_category_callback(query, data[4:])),
+    "add": ("add_ai_cat_", handle_add_ai_category_callback),
+}
+
 # Error handling wrapper
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Global error handler"""
-    logger.error(f"❌ Exception while handling update {update}: {context.error}")
-    logger.error(f"❌ Traceback: {traceback.format_exc()}")
+    # The error handler runs outside the failing call, so the traceback comes from context.error itself
+    logger.error("❌ Exception while handling update %s: %s", update, context.error, exc_info=context.error)
     
     # Try to send user-friendly error message
     try:
@@ -1866,6 +2729,27 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     except Exception:
         logger.error("❌ Could not send error message to user")
 
+def run_startup_checks():
+    """Test the Gemini and Google Sheets connections side by side, so startup waits for the slower one only"""
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix='startup-check') as pool:
+        gemini_test = pool.submit(lambda: get_model().generate_content("Hello, respond with 'Connection successful'"))
+        sheets_test = pool.submit(get_google_client)
+    
+    # Test Gemini connection
+    try:
+        print(f"✅ Gemini AI test: {gemini_test.result().text.strip()}")
+    except Exception as e:
+        print(f"⚠️ Gemini test warning: {e}")
+    
+    # Test Google Sheets connection
+    try:
+        if sheets_test.result():
+            print("✅ Google Sheets connection successful")
+        else:
+            print("⚠️ Google Sheets connection failed - check service account file")
+    except Exception as e:
+        print(f"⚠️ Google Sheets test warning: {e}")
+
 def main():
     """Enhanced main function with better error handling"""
     try:
@@ -1881,37 +2765,20 @@ def main():
         # Load data
         load_users()
         load_categories()
+        load_aggregates()
         
         # Validate environment
-        bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
-        gemini_key = os.getenv('GEMINI_API_KEY')
-        
-        if not bot_token:
-            raise ValueError("❌ TELEGRAM_BOT_TOKEN not found in .env file")
-        if not gemini_key:
-            raise ValueError("❌ GEMINI_API_KEY not found in .env file")
+        env, missing = validate_env()
+        if missing:
+            raise ValueError(f"❌ {missing[0]} not found in .env file")
         
         print("✅ Environment variables validated")
         
-        # Test Gemini connection
-        try:
-            test_response = model.generate_content("Hello, respond with 'Connection successful'")
-            print(f"✅ Gemini AI test: {test_response.text.strip()}")
-        except Exception as e:
-            print(f"⚠️ Gemini test warning: {e}")
-        
-        # Test Google Sheets connection
-        try:
-            gc = get_google_client()
-            if gc:
-                print("✅ Google Sheets connection successful")
-            else:
-                print("⚠️ Google Sheets connection failed - check service account file")
-        except Exception as e:
-            print(f"⚠️ Google Sheets test warning: {e}")
+        run_startup_checks()
         
         # Create application
-        app = Application.builder().token(bot_token).build()
+        app = (Application.builder().token(env['TELEGRAM_BOT_TOKEN'])
+               .post_init(start_background_tasks).post_shutdown(stop_write_flusher).build())
         
         # Add error handler
         app.add_error_handler(error_handler)
@@ -1946,13 +2813,13 @@ def main():
         print("   The bot now uses Gemini AI to make ALL decisions about user interactions.")
         print("   Send any message and Gemini will determine the best response!\n")
         
-        # Start polling with webhook cleanup
+        # run_polling deletes any webhook inside the running loop before the first
+        # getUpdates, so no separate delete_webhook call is needed here
         app.run_polling(drop_pending_updates=True)
         
     except Exception as e:
         print(f"❌ Critical startup error: {e}")
-        print(f"❌ Traceback: {traceback.format_exc()}")
-        logger.error(f"❌ Startup failed: {e}")
+        logger.error("❌ Startup failed: %s", e, exc_info=True)
         raise
 
 if __name__ == '__main__':
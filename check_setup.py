@@ -5,22 +5,30 @@ Check all dependencies and configuration for the Telegram bot
 
 import sys
 import os
-import importlib.util
+import re
+from importlib.metadata import distributions
+from env_config import validate_env, data_file_path
 
-def check_dependency(module_name, import_name=None):
-    """Check if a Python module is installed"""
-    if import_name is None:
-        import_name = module_name
-    
-    try:
-        if importlib.util.find_spec(import_name):
-            print(f"OK: {module_name}")
-            return True
-        else:
-            print(f"MISSING: {module_name}")
-            return False
-    except ImportError:
-        print(f"ERROR: {module_name}")
+_installed = None
+
+def normalize_name(name):
+    """Normalize a distribution name the way pip compares them (PEP 503)"""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+def installed_distributions():
+    """Names of all installed distributions, collected in a single scan of sys.path"""
+    global _installed
+    if _installed is None:
+        _installed = {normalize_name(d.metadata['Name']) for d in distributions() if d.metadata['Name']}
+    return _installed
+
+def check_dependency(package_name):
+    """Check if a Python package is installed"""
+    if normalize_name(package_name) in installed_distributions():
+        print(f"OK: {package_name}")
+        return True
+    else:
+        print(f"MISSING: {package_name}")
         return False
 
 def check_file(filepath):
@@ -32,6 +40,11 @@ def check_file(filepath):
         print(f"MISSING: {filepath}")
         return False
 
+def check_data_file(json_path):
+    """Check a bot data file, in whichever format the bot writes it (or still as legacy JSON)"""
+    path = data_file_path(json_path)
+    return check_file(path if os.path.exists(path) or not os.path.exists(json_path) else json_path)
+
 def main():
     print("=== TELEGRAM BOT SETUP VERIFICATION ===")
     print()
@@ -46,19 +59,19 @@ def main():
     files_ok &= check_file("C:/telegram4.0/bot_enhanced.py")
     files_ok &= check_file("C:/telegram4.0/.env")
     files_ok &= check_file("C:/telegram4.0/telegram_service_account.json")
-    files_ok &= check_file("C:/telegram4.0/categories.json")
-    files_ok &= check_file("C:/telegram4.0/users.json")
+    files_ok &= check_data_file("C:/telegram4.0/categories.json")
+    files_ok &= check_data_file("C:/telegram4.0/users.json")
     print()
     
     # Check Python dependencies
     print("--- PYTHON DEPENDENCIES ---")
     deps_ok = True
-    deps_ok &= check_dependency("python-telegram-bot", "telegram")
-    deps_ok &= check_dependency("google-generativeai", "google.generativeai")
+    deps_ok &= check_dependency("python-telegram-bot")
+    deps_ok &= check_dependency("google-generativeai")
     deps_ok &= check_dependency("gspread")
-    deps_ok &= check_dependency("google-auth", "google.auth")
-    deps_ok &= check_dependency("pillow", "PIL")
-    deps_ok &= check_dependency("python-dotenv", "dotenv")
+    deps_ok &= check_dependency("google-auth")
+    deps_ok &= check_dependency("pillow")
+    deps_ok &= check_dependency("python-dotenv")
     deps_ok &= check_dependency("requests")
     print()
     
@@ -67,21 +80,10 @@ def main():
     from dotenv import load_dotenv
     load_dotenv("C:/telegram4.0/.env")
     
-    env_ok = True
-    telegram_token = os.getenv('TELEGRAM_BOT_TOKEN')
-    gemini_key = os.getenv('GEMINI_API_KEY')
-    
-    if telegram_token:
-        print("SET: TELEGRAM_BOT_TOKEN")
-    else:
-        print("MISSING: TELEGRAM_BOT_TOKEN")
-        env_ok = False
-        
-    if gemini_key:
-        print("SET: GEMINI_API_KEY")
-    else:
-        print("MISSING: GEMINI_API_KEY")
-        env_ok = False
+    env, missing = validate_env()
+    for name in env:
+        print(f"{'MISSING' if name in missing else 'SET'}: {name}")
+    env_ok = not missing
     
     print()
     
@@ -0,0 +1,77 @@
+"""
+Shared API clients for the test scripts: built on first use, then reused by every
+script run in the same process
+"""
+
+import os
+import json
+import base64
+import functools
+import gspread
+import google.generativeai as genai
+from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+GEMINI_MODEL_NAME = 'gemini-1.5-flash'
+
+# Retry transient Sheets errors and quota (429) responses with backoff on the client's pooled session.
+# urllib3 only retries idempotent methods, so the create/append POSTs are never sent twice
+SHEETS_RETRY = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+
+# Like the bot: the key JSON (plain or base64) from GOOGLE_SERVICE_ACCOUNT_CREDENTIALS_JSON, otherwise
+# the key file named by GOOGLE_SERVICE_ACCOUNT_FILE
+CREDENTIALS_JSON_ENV = 'GOOGLE_SERVICE_ACCOUNT_CREDENTIALS_JSON'
+CREDENTIALS_FILE_ENV = 'GOOGLE_SERVICE_ACCOUNT_FILE'
+DEFAULT_SERVICE_ACCOUNT_FILE = 'telegram_service_account.json'
+SCOPE = ('https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive')
+
+def service_account_file():
+    """Path of the service account key file"""
+    return os.getenv(CREDENTIALS_FILE_ENV, DEFAULT_SERVICE_ACCOUNT_FILE)
+
+def credentials_available():
+    """Whether any service account credentials are configured"""
+    return bool(os.getenv(CREDENTIALS_JSON_ENV)) or os.path.exists(service_account_file())
+
+@functools.lru_cache(maxsize=4)
+def load_credentials(path, mtime_ns):
+    """Parse the service account key once per file version (mtime_ns is only part of the cache key)"""
+    return Credentials.from_service_account_file(path, scopes=SCOPE)
+
+@functools.lru_cache(maxsize=4)
+def load_credentials_json(service_account_json):
+    """Parse service account key JSON, base64 encoded or not"""
+    if not service_account_json.strip().startswith('{'):
+        service_account_json = base64.b64decode(service_account_json).decode('utf-8')
+    return Credentials.from_service_account_info(json.loads(service_account_json), scopes=SCOPE)
+
+def service_account_credentials():
+    """Credentials from the environment, falling back to the key file"""
+    service_account_json = os.getenv(CREDENTIALS_JSON_ENV)
+    if service_account_json:
+        return load_credentials_json(service_account_json)
+    path = service_account_file()
+    return load_credentials(path, os.stat(path).st_mtime_ns)
+
+@functools.cache
+def sheets_client():
+    """Authorized Sheets client with the retrying connection pool; the credentials refresh their token as needed"""
+    creds = service_account_credentials()
+    gc = gspread.authorize(creds)
+    gc.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=SHEETS_RETRY))
+    return gc
+
+@functools.cache
+def configure_gemini():
+    """Configure the Gemini SDK once per process"""
+    # No explicit transport: the SDK default is grpc for sync calls and grpc_asyncio for
+    # generate_content_async. Passing transport='grpc' would also force the async client onto
+    # the blocking transport, serializing --isolated runs and breaking its quota backoff
+    genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+
+@functools.cache
+def gemini_model():
+    """Plain Gemini model with default generation settings"""
+    configure_gemini()
+    return genai.GenerativeModel(GEMINI_MODEL_NAME)
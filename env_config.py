@@ -0,0 +1,24 @@
+"""
+Environment settings and data file naming shared by the bot and check_setup.py
+"""
+
+import os
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+REQUIRED_ENV_VARS = ('TELEGRAM_BOT_TOKEN', 'GEMINI_API_KEY')
+
+def validate_env():
+    """Read the required environment variables once, returning (values, missing names)"""
+    env = {name: os.getenv(name) for name in REQUIRED_ENV_VARS}
+    missing = [name for name, value in env.items() if not value]
+    return env, missing
+
+def data_file_path(json_path):
+    """On-disk path of a data file: a msgpack sibling of the JSON name when msgpack is installed"""
+    if msgpack:
+        return os.path.splitext(json_path)[0] + '.msgpack'
+    return json_path
@@ -1,77 +1,248 @@
 #!/usr/bin/env python3
 """
 Test script to verify Gemini AI parsing works before running the full bot
+
+Run with --isolated to send each test case as its own prompt (concurrently)
+instead of one batched prompt. Responses are cached on disk by model settings
+and prompt and marked (cached) in the output; pass --no-cache to query Gemini again.
 """
 
-import os
+import sys
+import re
 import json
+import asyncio
+import hashlib
+import inspect
+import shelve
 import google.generativeai as genai
+from google.api_core.exceptions import ResourceExhausted
 from dotenv import load_dotenv
+from clients import GEMINI_MODEL_NAME, configure_gemini, gemini_model
 
 # Load environment variables
 load_dotenv()
 
-def test_gemini_parsing():
-    """Test Gemini expense parsing"""
-    try:
-        genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        
-        test_cases = [
-            "Coffee $4.50 at Starbucks with credit card",
-            "Lunch 15 dollars McDonald's cash",
-            "Gas station $45.20 Shell debit card yesterday",
-            "Grocery shopping $67.89 Walmart"
-        ]
-        
-        for i, test_text in enumerate(test_cases, 1):
-            print(f"\n--- Test {i} ---")
-            print(f"Input: {test_text}")
-            
-            prompt = f"""Parse this expense text into JSON format:
-"{test_text}"
+TEST_CASES = [
+    "Coffee $4.50 at Starbucks with credit card",
+    "Lunch 15 dollars McDonald's cash",
+    "Gas station $45.20 Shell debit card yesterday",
+    "Grocery shopping $67.89 Walmart"
+]
 
-Return ONLY valid JSON with these exact fields:
-{{
+# Isolated mode: at most this many prompts in flight, retrying quota errors with backoff
+ISOLATED_CONCURRENCY = 5
+QUOTA_RETRIES = 6
+
+# First fenced block in a response, with or without the json language tag
+JSON_FENCE_RE = re.compile(r'```(?:json)?\s*(.*?)```', re.S)
+
+# Responses from earlier runs, keyed by a hash of the model settings and the prompt
+CACHE_FILE = 'gemini_test_cache'
+USE_CACHE = '--no-cache' not in sys.argv[1:]
+
+FIELDS_SPEC = """{
   "amount": number,
   "category": "string",
-  "description": "string", 
+  "description": "string",
   "payment_method": "string",
   "date": "YYYY-MM-DD"
-}}
+}
 
 Use today's date if no date is mentioned.
 Amount should be a number without currency symbols."""
 
-            response = model.generate_content(prompt)
-            result = response.text.strip()
-            
-            print(f"Gemini Response: {result}")
-            
-            # Clean up response (Gemini sometimes adds extra text)
-            clean_result = result
-            if '```json' in result:
-                clean_result = result.split('```json')[1].split('```')[0].strip()
-            elif '```' in result:
-                clean_result = result.split('```')[1].split('```')[0].strip()
-            
+# Isolated mode instructions, sent once as the system instruction when the SDK supports it
+# (google-generativeai >= 0.5) so each request carries only the expense text
+ISOLATED_INSTRUCTION = f"""Parse the expense text into JSON format.
+
+Return ONLY valid JSON with these exact fields:
+{FIELDS_SPEC}"""
+SYSTEM_INSTRUCTION_SUPPORTED = 'system_instruction' in inspect.signature(genai.GenerativeModel).parameters
+
+# Structured output: JSON mode returns bare JSON (no code fences) and a schema pins the fields.
+# Older SDKs (such as the pinned 0.3.2) have neither, so responses still go through clean_json
+GENERATION_CONFIG_FIELDS = inspect.signature(genai.types.GenerationConfig).parameters
+JSON_MODE_SUPPORTED = 'response_mime_type' in GENERATION_CONFIG_FIELDS
+SCHEMA_SUPPORTED = 'response_schema' in GENERATION_CONFIG_FIELDS
+
+EXPENSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "amount": {"type": "number"},
+        "category": {"type": "string"},
+        "description": {"type": "string"},
+        "payment_method": {"type": "string"},
+        "date": {"type": "string"}
+    },
+    "required": ["amount", "category", "description", "payment_method", "date"]
+}
+EXPENSE_LIST_SCHEMA = {"type": "array", "items": EXPENSE_SCHEMA}
+
+def get_model(system_instruction=None, response_schema=None):
+    """Return the model under test, using whichever structured output options the SDK has,
+    and a description of those settings for the response cache key"""
+    configure_gemini()
+    options = {}
+    if system_instruction and SYSTEM_INSTRUCTION_SUPPORTED:
+        options['system_instruction'] = system_instruction
+    generation_config = {}
+    if JSON_MODE_SUPPORTED:
+        generation_config['response_mime_type'] = 'application/json'
+        if response_schema and SCHEMA_SUPPORTED:
+            generation_config['response_schema'] = response_schema
+    # A changed model, instruction or schema must not be answered from an older run's cache
+    cache_context = json.dumps({'model': GEMINI_MODEL_NAME, 'system_instruction': system_instruction,
+                                'response_schema': response_schema, 'options': sorted(options),
+                                'generation_config': generation_config}, sort_keys=True)
+    if not options and not generation_config:
+        return gemini_model(), cache_context
+    model = genai.GenerativeModel(GEMINI_MODEL_NAME, generation_config=generation_config or None, **options)
+    return model, cache_context
+
+def prompt_key(cache_context, prompt):
+    """Cache key for a prompt sent with the given model settings"""
+    return hashlib.blake2b(f"{cache_context}\n{prompt}".encode('utf-8')).hexdigest()
+
+def get_cached_response(cache_context, prompt):
+    """Return the stored response for a prompt, or None on a miss or with --no-cache"""
+    if not USE_CACHE:
+        return None
+    with shelve.open(CACHE_FILE) as cache:
+        return cache.get(prompt_key(cache_context, prompt))
+
+def store_response(cache_context, prompt, text):
+    """Remember a response for later runs"""
+    with shelve.open(CACHE_FILE) as cache:
+        cache[prompt_key(cache_context, prompt)] = text
+
+def call_gemini(model, cache_context, prompt):
+    """Generate a response, reusing the cached one when available; returns (text, from_cache)"""
+    cached = get_cached_response(cache_context, prompt)
+    if cached is not None:
+        return cached, True
+    text = model.generate_content(prompt).text.strip()
+    store_response(cache_context, prompt, text)
+    return text, False
+
+def clean_json(result):
+    """Strip the code fences Gemini sometimes wraps around JSON"""
+    match = JSON_FENCE_RE.search(result)
+    return match.group(1).strip() if match else result
+
+def response_json(result):
+    """The JSON part of a response; fences only need stripping outside JSON mode"""
+    return result if JSON_MODE_SUPPORTED else clean_json(result)
+
+def cached_label(from_cache):
+    """Suffix marking output that came from the response cache"""
+    return " (cached)" if from_cache else ""
+
+def print_parsed(i, test_text, parsed, from_cache=False):
+    """Print one parsed test case"""
+    print(f"\n--- Test {i}{cached_label(from_cache)} ---")
+    print(f"Input: {test_text}")
+    print("Valid JSON!")
+    print(f"Amount: ${parsed['amount']}")
+    print(f"Category: {parsed['category']}")
+    print(f"Description: {parsed['description']}")
+    print(f"Payment: {parsed['payment_method']}")
+    print(f"Date: {parsed['date']}")
+
+def test_gemini_parsing():
+    """Test Gemini expense parsing"""
+    try:
+        model, cache_context = get_model(response_schema=EXPENSE_LIST_SCHEMA)
+
+        # One request for all cases: the instructions are sent once and there is a single round-trip
+        numbered_cases = "\n".join(f'{i}. "{test_text}"' for i, test_text in enumerate(TEST_CASES, 1))
+        prompt = f"""Parse each of these expense texts into JSON format:
+{numbered_cases}
+
+Return ONLY a valid JSON array with one object per text, in the same order, each with these exact fields:
+{FIELDS_SPEC}"""
+
+        result, from_cache = call_gemini(model, cache_context, prompt)
+
+        print(f"Gemini Response{cached_label(from_cache)}: {result}")
+
+        # Clean up response (Gemini sometimes adds extra text)
+        clean_result = response_json(result)
+
+        try:
+            parsed_list = json.loads(clean_result)
+        except json.JSONDecodeError:
+            print("Invalid JSON returned by Gemini")
+            print(f"Cleaned result: {clean_result}")
+            return
+
+        if not isinstance(parsed_list, list) or len(parsed_list) != len(TEST_CASES):
+            print(f"Expected a JSON array of {len(TEST_CASES)} results")
+            return
+
+        for i, (test_text, parsed) in enumerate(zip(TEST_CASES, parsed_list), 1):
+            print_parsed(i, test_text, parsed, from_cache)
+
+    except Exception as e:
+        print(f"Error: {e}")
+        print("Check your GEMINI_API_KEY in .env file")
+
+async def parse_isolated(model, cache_context, semaphore, test_text):
+    """Parse one test case in its own prompt, backing off on quota errors; returns (text, from_cache)"""
+    if SYSTEM_INSTRUCTION_SUPPORTED:
+        prompt = test_text
+    else:
+        prompt = f"""Parse this expense text into JSON format:
+"{test_text}"
+
+Return ONLY valid JSON with these exact fields:
+{FIELDS_SPEC}"""
+    cached = get_cached_response(cache_context, prompt)
+    if cached is not None:
+        return cached, True
+    async with semaphore:
+        for attempt in range(QUOTA_RETRIES):
             try:
-                parsed = json.loads(clean_result)
-                print("Valid JSON!")
-                print(f"Amount: ${parsed['amount']}")
-                print(f"Category: {parsed['category']}")
-                print(f"Description: {parsed['description']}")
-                print(f"Payment: {parsed['payment_method']}")
-                print(f"Date: {parsed['date']}")
+                response = await model.generate_content_async(prompt)
+                text = response.text.strip()
+                store_response(cache_context, prompt, text)
+                return text, False
+            except ResourceExhausted:
+                if attempt == QUOTA_RETRIES - 1:
+                    raise
+                await asyncio.sleep(10 * 2 ** attempt)
+
+async def run_isolated_parsing():
+    """Test Gemini expense parsing with one prompt per case, run concurrently"""
+    try:
+        model, cache_context = get_model(ISOLATED_INSTRUCTION, EXPENSE_SCHEMA)
+        semaphore = asyncio.Semaphore(ISOLATED_CONCURRENCY)
+        results = await asyncio.gather(
+            *(parse_isolated(model, cache_context, semaphore, test_text) for test_text in TEST_CASES),
+            return_exceptions=True
+        )
+
+        for i, (test_text, result) in enumerate(zip(TEST_CASES, results), 1):
+            if isinstance(result, Exception):
+                print(f"\n--- Test {i} ---")
+                print(f"Error: {result}")
+                continue
+            result, from_cache = result
+            clean_result = response_json(result)
+            try:
+                print_parsed(i, test_text, json.loads(clean_result), from_cache)
             except json.JSONDecodeError:
+                print(f"\n--- Test {i}{cached_label(from_cache)} ---")
                 print("Invalid JSON returned by Gemini")
                 print(f"Cleaned result: {clean_result}")
-                
+
     except Exception as e:
         print(f"Error: {e}")
         print("Check your GEMINI_API_KEY in .env file")
 
 if __name__ == "__main__":
     print("Testing Gemini AI Expense Parsing...")
-    test_gemini_parsing()
+    if '--isolated' in sys.argv[1:]:
+        asyncio.run(run_isolated_parsing())
+    else:
+        test_gemini_parsing()
     print("\nTest complete!")
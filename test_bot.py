@@ -1,16 +1,30 @@
 #!/usr/bin/env python3
 """
 Quick test to verify Telegram bot token works
+
+Run with --offline to check the handler wiring without Telegram: fake updates
+are processed in-process and the bot's API calls are answered locally.
 """
 
 import os
+import sys
+import json
+import time
+import asyncio
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.request import BaseRequest
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# Placeholder identity used by --offline, which never contacts Telegram
+OFFLINE_TOKEN = '123456:OFFLINE'
+OFFLINE_BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Offline Bot', 'username': 'offline_bot'}
+OFFLINE_CHAT = {'id': 1, 'type': 'private', 'first_name': 'Tester'}
+OFFLINE_MESSAGES = ["/start", "Coffee 50"]
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Test start command"""
     await update.message.reply_text(
@@ -24,16 +38,98 @@ async def test_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Test text messages"""
     await update.message.reply_text(f"You said: {update.message.text}")
 
-def main():
-    """Test the bot connection"""
-    app = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
-    
+class OfflineRequest(BaseRequest):
+    """Answers Bot API calls locally, recording the text of every message the bot sends"""
+
+    def __init__(self):
+        self.sent_texts = []
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if endpoint == 'getMe':
+            result = OFFLINE_BOT_USER
+        elif endpoint == 'sendMessage':
+            self.sent_texts.append(params['text'])
+            result = {'message_id': len(self.sent_texts), 'date': int(time.time()),
+                      'chat': {'id': params['chat_id'], 'type': 'private'}, 'text': params['text']}
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode('utf-8')
+
+def build_app(token, request=None):
+    """Create the test application with its handlers"""
+    builder = Application.builder().token(token).concurrent_updates(True)
+    if request:
+        builder = builder.request(request).get_updates_request(OfflineRequest())
+    app = builder.build()
+
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, test_message))
-    
+    return app
+
+def offline_update(update_id, text):
+    """Build the update Telegram would send for a private text message"""
+    message = {'message_id': update_id, 'date': int(time.time()), 'chat': OFFLINE_CHAT,
+               'from': {'id': OFFLINE_CHAT['id'], 'is_bot': False, 'first_name': 'Tester'}, 'text': text}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+async def run_offline_check():
+    """Feed fake updates through the handlers and report the replies"""
+    request = OfflineRequest()
+    app = build_app(OFFLINE_TOKEN, request)
+    await app.initialize()
+    try:
+        for update_id, text in enumerate(OFFLINE_MESSAGES, 1):
+            await app.process_update(Update.de_json(offline_update(update_id, text), app.bot))
+    finally:
+        await app.shutdown()
+
+    for text, reply in zip(OFFLINE_MESSAGES, request.sent_texts):
+        print(f"{text!r} -> {reply.splitlines()[0]!r}")
+    ok = len(request.sent_texts) == len(OFFLINE_MESSAGES)
+    print("Offline handler check passed!" if ok else "Offline handler check failed: missing replies")
+    return ok
+
+def main():
+    """Test the bot connection"""
+    if '--offline' in sys.argv[1:]:
+        sys.exit(0 if asyncio.run(run_offline_check()) else 1)
+
+    token = os.getenv('TELEGRAM_BOT_TOKEN')
+    app = build_app(token)
+
     print("Testing bot connection...")
     print("Send /start to your bot to test!")
-    app.run_polling()
+    # Webhook mode (needs python-telegram-bot[webhooks] and a public HTTPS URL, e.g. a tunnel):
+    # Telegram pushes each update instead of the bot fetching it
+    webhook_base = os.getenv('WEBHOOK_URL')
+    if webhook_base:
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv('WEBHOOK_PORT', '8443')),
+            url_path=token,
+            webhook_url=f"{webhook_base.rstrip('/')}/{token}",
+            secret_token=os.getenv('WEBHOOK_SECRET'),
+            allowed_updates=Update.ALL_TYPES
+        )
+        return
+
+    # Long polling: Telegram holds each getUpdates open for up to 20s and answers as soon as an update arrives
+    app.run_polling(timeout=20, poll_interval=0.0, bootstrap_retries=-1, allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
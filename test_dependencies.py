@@ -4,82 +4,110 @@ Quick test script for Telegram Bot dependencies
 """
 import sys
 import os
+import importlib.util
+import importlib.metadata
+from concurrent.futures import ThreadPoolExecutor
+from env_config import REQUIRED_ENV_VARS
 
-def test_dependencies():
-    print("Testing Telegram Bot Dependencies...")
-    print("=" * 50)
-    
-    # Test Python version
-    print(f"Python Version: {sys.version}")
-    
-    # Test imports
+# (module to look up, distribution whose version is reported)
+DEPENDENCIES = (
+    ('telegram', 'python-telegram-bot'),
+    ('google.generativeai', 'google-generativeai'),
+    ('gspread', 'gspread'),
+    ('PIL', 'Pillow'),
+    ('dotenv', 'python-dotenv'),
+)
+
+# Parsed .env contents, read at most once per run
+env_file_cache = None
+
+def read_env_file(path='.env'):
+    """Minimal KEY=VALUE reader: this script only checks that keys are set, so dotenv's quoting and expansion aren't needed"""
+    global env_file_cache
+    if env_file_cache is None:
+        env_file_cache = {}
+        with open(path, encoding='utf-8', errors='ignore') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                key, _, value = line.partition('=')
+                env_file_cache[key.removeprefix('export ').strip()] = value.strip().strip('"\'')
+    return env_file_cache
+
+def probe_dependency(dependency):
+    """Check one (module, distribution) pair without importing it, returning the status line"""
+    module_name, dist_name = dependency
+    # Installed distributions answer from their dist-info metadata alone
     try:
-        import telegram
-        print(f"[OK] python-telegram-bot: {telegram.__version__}")
-    except ImportError as e:
-        print(f"[FAIL] python-telegram-bot: {e}")
-        return False
-    
+        return True, f"[OK] {dist_name}: {importlib.metadata.version(dist_name)}"
+    except importlib.metadata.PackageNotFoundError:
+        pass
+    # No metadata (e.g. a copied-in module): fall back to locating it. find_spec imports
+    # parent packages, such as google for google.generativeai, so it's the slower path
     try:
-        import google.generativeai as genai
-        print("[OK] google-generativeai: Imported successfully")
-    except ImportError as e:
-        print(f"[FAIL] google-generativeai: {e}")
-        return False
+        spec = importlib.util.find_spec(module_name)
+    except ModuleNotFoundError:
+        spec = None
+    if spec is None:
+        return False, f"[FAIL] {dist_name}: No module named '{module_name}'"
+    return True, f"[OK] {dist_name}: Found"
+
+def collect_dependency_report(lines):
+    """Run the checks, appending report lines; returns whether the core dependencies are present"""
+    lines.append("Testing Telegram Bot Dependencies...")
+    lines.append("=" * 50)
     
-    try:
-        import gspread
-        print(f"[OK] gspread: {gspread.__version__}")
-    except ImportError as e:
-        print(f"[FAIL] gspread: {e}")
-        return False
+    # Test Python version
+    lines.append(f"Python Version: {sys.version}")
     
-    try:
-        import PIL
-        print(f"[OK] Pillow: {PIL.__version__}")
-    except ImportError as e:
-        print(f"[FAIL] Pillow: {e}")
-        return False
+    # Test packages are installed without importing them; the probes are independent
+    # filesystem lookups, so they run side by side and are reported in table order
+    with ThreadPoolExecutor(max_workers=len(DEPENDENCIES)) as pool:
+        results = list(pool.map(probe_dependency, DEPENDENCIES))
+    for found, line in results:
+        lines.append(line)
+        if not found:
+            return False
     
-    try:
-        import dotenv
-        print("[OK] python-dotenv: Imported successfully")
-    except ImportError as e:
-        print(f"[FAIL] python-dotenv: {e}")
-        return False
+    # One directory listing answers both file checks below
+    with os.scandir('.') as entries:
+        file_names = {entry.name for entry in entries}
     
     # Test .env file
-    if os.path.exists('.env'):
-        print("[OK] .env file: Found")
-        from dotenv import load_dotenv
-        load_dotenv()
+    if '.env' in file_names:
+        lines.append("[OK] .env file: Found")
+        env_file = read_env_file()
         
-        bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
-        gemini_key = os.getenv('GEMINI_API_KEY')
-        
-        if bot_token:
-            print("[OK] TELEGRAM_BOT_TOKEN: Configured")
-        else:
-            print("[FAIL] TELEGRAM_BOT_TOKEN: Missing")
-            
-        if gemini_key:
-            print("[OK] GEMINI_API_KEY: Configured")
-        else:
-            print("[FAIL] GEMINI_API_KEY: Missing")
+        # Like load_dotenv, variables already in the environment take precedence
+        for name in REQUIRED_ENV_VARS:
+            if os.getenv(name) or env_file.get(name):
+                lines.append(f"[OK] {name}: Configured")
+            else:
+                lines.append(f"[FAIL] {name}: Missing")
     else:
-        print("[FAIL] .env file: Not found")
+        lines.append("[FAIL] .env file: Not found")
     
     # Test service account
-    if os.path.exists('telegram_service_account.json'):
-        print("[OK] Google Service Account: Found")
+    if 'telegram_service_account.json' in file_names:
+        lines.append("[OK] Google Service Account: Found")
     else:
-        print("[WARN] Google Service Account: Not found (Sheets won't work)")
+        lines.append("[WARN] Google Service Account: Not found (Sheets won't work)")
     
-    print("=" * 50)
-    print("SUCCESS: All core dependencies are working!")
-    print("Your bot should run without issues!")
+    lines.append("=" * 50)
+    lines.append("SUCCESS: All core dependencies are working!")
+    lines.append("Your bot should run without issues!")
     return True
 
+def test_dependencies():
+    """Check dependencies and configuration, printing the report in one write"""
+    lines = []
+    try:
+        return collect_dependency_report(lines)
+    finally:
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+
 if __name__ == "__main__":
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
     test_dependencies()
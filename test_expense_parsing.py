@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Tests for the local (no Gemini) expense parsing fast path in bot_enhanced.py
+"""
+
+from bot_enhanced import DEFAULT_CATEGORIES, NUMBER_RE, parse_expense_locally, parse_number
+
+def parse(text):
+    return parse_expense_locally(text, DEFAULT_CATEGORIES)
+
+def test_indian_grouped_amount():
+    assert parse("₹1,500 grocery")['amount'] == 1500
+    assert parse("rs. 1,20,000 uber")['amount'] == 120000
+
+def test_western_grouped_amount():
+    assert parse("Paid ₹2,500 for grocery")['amount'] == 2500
+    assert parse("₹120,000.50 uber")['amount'] == 120000.5
+
+def test_plain_amounts():
+    assert parse("₹250 uber")['amount'] == 250
+    assert parse("paid 80.5 for lunch at zomato")['amount'] == 80.5
+
+def test_merchant_keeps_apostrophe_and_casing():
+    assert parse("₹300 lunch at McDonald's")['merchant'] == "McDonald's"
+    assert parse("paid 80 for lunch at zomato")['merchant'] == "Zomato"
+
+def test_merchant_spans_words_up_to_payment_or_amount():
+    assert parse("₹400 grocery at big bazaar via upi")['merchant'] == "Big Bazaar"
+    assert parse("₹400 grocery at big bazaar")['merchant'] == "Big Bazaar"
+    assert parse("₹250 uber to office")['merchant'] == "Unknown"
+
+def test_ambiguous_texts_are_left_to_gemini():
+    assert parse("movie ₹300 and food ₹200") is None
+    assert parse("I spent 500 on food yesterday") is None
+    assert parse("refund ₹500 from amazon") is None
+
+def test_corrected_amount_reply():
+    assert parse_number(NUMBER_RE.search("make it 1,20,000 please").group()) == 120000
+    assert parse_number(NUMBER_RE.search("450").group()) == 450
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+    print("All expense parsing tests passed!")
@@ -1,48 +1,76 @@
 #!/usr/bin/env python3
 """
 Test Google Sheets connection
+
+Run directly for a one-off check, or under pytest, where every test shares one
+spreadsheet created for the session and deleted at teardown.
 """
 
-import gspread
-from google.oauth2.service_account import Credentials
+import contextlib
+from dotenv import load_dotenv
+from clients import CREDENTIALS_FILE_ENV, CREDENTIALS_JSON_ENV, credentials_available, sheets_client
+
+try:
+    import pytest
+except ImportError:
+    pytest = None
+
+# Load environment variables
+load_dotenv()
+
+TEST_HEADERS = ['Date', 'Amount', 'Category', 'Description', 'Payment Method']
+TEST_ROW = ['2024-06-04', 5.50, 'Coffee', 'Test expense', 'Credit Card']
+
+@contextlib.contextmanager
+def temporary_spreadsheet():
+    """Create the test spreadsheet and delete it afterwards"""
+    gc = sheets_client()
+    spreadsheet = gc.create("Test_Expense_Bot")
+    try:
+        yield spreadsheet
+    finally:
+        gc.del_spreadsheet(spreadsheet.id)
+
+def write_test_rows(spreadsheet):
+    """Write headers and a test row into A1:E2 in one request (overwrites, so reruns on a shared sheet are fine)"""
+    spreadsheet.sheet1.update('A1:E2', [TEST_HEADERS, TEST_ROW])
+
+if pytest:
+    @pytest.fixture(scope="session")
+    def shared_sheet():
+        """One spreadsheet for the whole test session instead of a create/delete per test"""
+        if not credentials_available():
+            pytest.skip(f"no Google credentials: set {CREDENTIALS_JSON_ENV} or {CREDENTIALS_FILE_ENV}")
+        with temporary_spreadsheet() as spreadsheet:
+            yield spreadsheet
 
-def test_google_sheets():
+def test_google_sheets(shared_sheet):
+    """Test writing to and reading back from a sheet"""
+    write_test_rows(shared_sheet)
+    assert shared_sheet.sheet1.row_values(1) == TEST_HEADERS
+
+def check_google_sheets():
     """Test Google Sheets API connection"""
     try:
         print("Testing Google Sheets connection...")
-        
-        # Initialize Google Sheets client
-        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        creds = Credentials.from_service_account_file('C:/telegram4.0/telegram_service_account.json', scopes=scope)
-        gc = gspread.authorize(creds)
-        
-        print("Google Sheets API connected successfully!")
-        
+
         # Test creating a sheet
         print("Testing sheet creation...")
-        test_sheet = gc.create("Test_Expense_Bot")
-        sheet = test_sheet.sheet1
-        
-        # Add headers
-        headers = ['Date', 'Amount', 'Category', 'Description', 'Payment Method']
-        sheet.append_row(headers)
-        
-        # Add a test row
-        test_row = ['2024-06-04', 5.50, 'Coffee', 'Test expense', 'Credit Card']
-        sheet.append_row(test_row)
-        
-        print(f"Test sheet created: {test_sheet.url}")
-        print("Headers and test data added successfully!")
-        
-        # Clean up - delete the test sheet
-        gc.del_spreadsheet(test_sheet.id)
+        with temporary_spreadsheet() as test_sheet:
+            print("Google Sheets API connected successfully!")
+
+            write_test_rows(test_sheet)
+
+            print(f"Test sheet created: {test_sheet.url}")
+            print("Headers and test data added successfully!")
+
         print("Test sheet deleted (cleanup)")
-        
+
         return True
-        
+
     except Exception as e:
         print(f"Google Sheets test failed: {e}")
         return False
 
 if __name__ == "__main__":
-    test_google_sheets()
+    check_google_sheets()
@@ -3,18 +3,46 @@
 Simple syntax test for bot_enhanced.py
 """
 
-import ast
+import glob
+import marshal
+import mmap
+import os
 import sys
 
+CACHE_DIR = '__pycache__'
+
+def syntax_cache_path(filename, mtime_ns):
+    """Where the compiled code for this version of the file is kept"""
+    base = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(CACHE_DIR, f"{base}.syntest.{mtime_ns}.pyc")
+
 def test_syntax(filename):
     """Test if the Python file has valid syntax"""
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            source = f.read()
+        # A file that compiled before and hasn't changed since needs only a stat
+        stat = os.stat(filename)
+        cache_path = syntax_cache_path(filename, stat.st_mtime_ns)
+        if os.path.exists(cache_path):
+            print(f"SUCCESS: {filename} has valid syntax! (unchanged)")
+            return True
         
-        # Parse the AST to check for syntax errors
-        ast.parse(source)
+        # Compile to check for syntax errors without building the AST objects.
+        # The source is mapped rather than read into a string; compile() handles the encoding
+        if stat.st_size == 0:
+            code = compile(b'', filename, 'exec', dont_inherit=True)
+        else:
+            with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as source:
+                code = compile(source, filename, 'exec', dont_inherit=True)
         print(f"SUCCESS: {filename} has valid syntax!")
+        
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            for stale in glob.glob(syntax_cache_path(filename, '*')):
+                os.remove(stale)
+            with open(cache_path, 'wb') as f:
+                marshal.dump(code, f)
+        except OSError:
+            pass  # The cache only saves time; the check itself passed
         return True
         
     except SyntaxError as e: